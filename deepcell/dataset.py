@@ -5,7 +5,8 @@ from __future__ import print_function
 """
 dataset.py
 
-Executing functions for creating npz files containing the training data
+Executing functions for creating the training data directories (memory-mappable
+.npy arrays plus a manifest.json)
 Functions will create training dataset.
 
 Files should be plased in training directories with each separate
@@ -34,7 +35,7 @@ def main():
 	# Load data
 	root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 	direc_name = os.path.join(root, "DATA/train/" + args.dataset)
-	file_name_save = os.path.join(root, 'DATA/train_npz/' + args.dataset + '.npz')
+	file_name_save = os.path.join(root, 'DATA/train_npz/' + args.dataset)
 	training_direcs = os.listdir(direc_name)
 	training_direcs = ["set1", "set2", "set3"]
 	files = os.listdir(os.path.join(direc_name, training_direcs[0]))
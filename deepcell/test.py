@@ -24,7 +24,7 @@ from skimage.measure import label
 
 from utils.helper import nikon_getfiles, get_image, get_image_sizes
 from utils.cnn import run_models_on_directory
-from utils.segmentation import segment_nuclei, segment_cytoplasm
+from utils.segmentation import segment_nuclei, segment_cytoplasm, score_cells
 from utils.indice import dice_jaccard_indices
 
 from utils.model import dilated_bn_feature_net_61x61 as network
@@ -47,6 +47,16 @@ def main():
 					default=30, help="window size of cyto model")
 	parser.add_argument("--win_nuclear", type=int,
 					default=30, help="window size of nuclear model")
+	parser.add_argument("--cache_size", type=int,
+					default=0, help="size cap in MB of a preprocessing cache under DATA/preprocessing_cache, 0 (default) disables it")
+	parser.add_argument("--segmentation_workers", type=int,
+					default=1, help="number of processes segmenting frames in parallel")
+	parser.add_argument("--segmentation_threads", action="store_true",
+					help="segment frames on threads instead of processes")
+	parser.add_argument("--contour_tolerance", type=int,
+					default=None, help="stop the active contours once at most this many pixels changed over 4 iterations")
+	parser.add_argument("--local_contours", action="store_true",
+					help="evolve the active contours of each cell on a crop around its nucleus")
 	args = parser.parse_args()
 
 	root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -76,6 +86,13 @@ def main():
 
 	image_size_x, image_size_y = get_image_sizes(data_location, cyto_channel_names)
 
+	if args.cache_size > 0:
+		cache_dir = os.path.join(root, "DATA/preprocessing_cache")
+		cache_size = args.cache_size * 2**20
+		print("Caching preprocessed images in " + cache_dir + " (up to " + str(args.cache_size) + " MB)")
+	else:
+		cache_dir, cache_size = None, None
+
 	"""
 	Define model
 	"""
@@ -97,22 +114,26 @@ def main():
 
 	cytoplasm_predictions = run_models_on_directory(data_location, cyto_channel_names, cyto_location,
 			n_features=3, model_fn=network, list_of_weights=list_of_cyto_weights, image_size_x=image_size_x,
-			image_size_y=image_size_y, win_x=win_cyto, win_y=win_cyto, std=True, split=True)
+			image_size_y=image_size_y, win_x=win_cyto, win_y=win_cyto, std=True, split=True,
+			cache_dir=cache_dir, cache_size=cache_size)
 
 	run_models_on_directory(data_location, nuclear_channel_names, nuclear_location,
 			model_fn=network, list_of_weights=list_of_nuclear_weights,
 			image_size_x=image_size_x, image_size_y=image_size_y,
-			win_x=win_nuclear, win_y=win_nuclear, std=False, split=False)
+			win_x=win_nuclear, win_y=win_nuclear, std=False, split=False,
+			cache_dir=cache_dir, cache_size=cache_size)
 
 	"""
 	Refine segmentation with active contours
 	"""
 
 	nuclear_masks = segment_nuclei(img=None, color_image=True, load_from_direc=nuclear_location,
-			mask_location=mask_location, area_threshold=100, solidity_threshold=0, eccentricity_threshold=1)
+			mask_location=mask_location, area_threshold=100, solidity_threshold=0, eccentricity_threshold=1,
+			workers=args.segmentation_workers, threads=args.segmentation_threads)
 
 	cytoplasm_masks = segment_cytoplasm(img=None, load_from_direc=cyto_location, color_image=True,
-			nuclear_masks=nuclear_masks, mask_location=mask_location, smoothing=1, num_iters=120)
+			nuclear_masks=nuclear_masks, mask_location=mask_location, smoothing=1, num_iters=120, tolerance=args.contour_tolerance,
+			local=args.local_contours, workers=args.segmentation_workers, threads=args.segmentation_threads)
 
 	"""
 	Compute validation metrics (optional)
@@ -136,22 +157,9 @@ def main():
 	interior1 = cytoplasm_predictions[0, 1, :, :]
 	interior2 = cytoplasm_predictions[0, 2, :, :]
 	seg = label(cytoplasm_masks[0, :, :])
-	num_of_cells = np.amax(seg)
-	prediction = np.zeros(interior1.shape, dtype=np.float32)
-	prediction_color = np.zeros((interior1.shape[0], interior1.shape[1], 3), dtype=np.float32)
+	prediction, prediction_color = score_cells(seg, interior1, interior2, cmap=plt.cm.coolwarm)
 
 	bound = segmentation.find_boundaries(seg)
-	for cell_no in xrange(1, num_of_cells):
-		class_1_pred = interior1[seg == cell_no]
-		class_2_pred = interior2[seg == cell_no]
-		# class_1_score = np.sum(class_1_pred) / (np.sum(class_1_pred) + np.sum(class_2_pred))
-		class_2_score = np.sum(class_2_pred) / (np.sum(class_1_pred) + np.sum(class_2_pred))
-
-		prediction[seg == cell_no] = class_2_score
-		prediction_color[seg == cell_no, 0] = plt.cm.coolwarm(class_2_score)[0]
-		prediction_color[seg == cell_no, 1] = plt.cm.coolwarm(class_2_score)[1]
-		prediction_color[seg == cell_no, 2] = plt.cm.coolwarm(class_2_score)[2]
-
 	prediction_color[bound, 0] = 0
 	prediction_color[bound, 1] = 0
 	prediction_color[bound, 2] = 0
@@ -39,6 +39,10 @@ def main():
 	parser.add_argument("-f", "--n_features", type=int,
 						default=3, help="must be num_of_features in dataset.py plus 1")
 	parser.add_argument("--dist", type=int, default=0, help="1 to use distrbution training")
+	parser.add_argument("-w", "--workers", type=int,
+						default=0, help="number of data loading processes, 0 to load in the training process")
+	parser.add_argument("-p", "--prefetch", type=int,
+						default=None, help="number of batches loaded ahead by the workers")
 	args = parser.parse_args()
 
 	if args.dist:
@@ -78,7 +82,8 @@ def main():
 				expt=expt, it=iterate, batch_size=batch_size, n_epoch=n_epoch,
 				direc_save=direc_save, direc_data=direc_data,
 				class_weight=class_weights,
-				rotation_range=180, flip=True, shear=False, dist=args.dist)
+				rotation_range=180, flip=True, shear=False, dist=args.dist,
+				workers=args.workers, prefetch=args.prefetch)
 
 if __name__ == "__main__":
 	main()
@@ -9,6 +9,7 @@ Functions for building and training convolutional neural networks
 """
 
 from itertools import cycle
+from collections import deque
 import numpy as np
 import mahotas as mh
 
@@ -19,7 +20,7 @@ matplotlib.get_backend()
 from skimage import morphology as morph
 from skimage.segmentation import find_boundaries
 
-from scipy.ndimage import binary_dilation, binary_erosion
+from scipy.ndimage import binary_dilation, binary_erosion, find_objects
 
 """
 Active contours
@@ -58,52 +59,97 @@ _P3[6][[0, 1, 2], :, [2, 1, 0]] = 1
 _P3[7][[0, 1, 2], [0, 1, 2], :] = 1
 _P3[8][[0, 1, 2], [2, 1, 0], :] = 1
 
-_aux = np.zeros((0))
-def SI(u):
-	"""SI operator."""
-	global _aux
-	if np.ndim(u) == 2:
-		P = _P2
-	elif np.ndim(u) == 3:
-		P = _P3
-	else:
-		raise ValueError, "u has an invalid number of dimensions (should be 2 or 3)"
-
-	if u.shape != _aux.shape[1:]:
-		_aux = np.zeros((len(P),) + u.shape)
-
-	for i in xrange(len(P)):
-		_aux[i] = binary_erosion(u, P[i])
+def _structure_offsets(P):
+	"""Offsets from the centre of the pixels of a structuring element."""
+	return [tuple(offset) for offset in np.argwhere(P) - np.array(P.shape) // 2]
 
-	return _aux.max(0)
+_P2_OFFSETS = [_structure_offsets(P) for P in _P2]
+_P3_OFFSETS = [_structure_offsets(P) for P in _P3]
 
-def IS(u):
-	"""IS operator."""
-	global _aux
+def _operator_support(u):
+	"""Nonzero pixels of u, cropped to their bounding box grown by one pixel
+	and zero padded by one more, and the slices of that box. SI and IS are
+	zero outside of it. Returns None when u is empty."""
 	if np.ndim(u) == 2:
-		P = _P2
+		offsets = _P2_OFFSETS
 	elif np.ndim(u) == 3:
-		P = _P3
+		offsets = _P3_OFFSETS
 	else:
 		raise ValueError, "u has an invalid number of dimensions (should be 2 or 3)"
 
-	if u.shape != _aux.shape[1:]:
-		_aux = np.zeros((len(P),) + u.shape)
+	nonzero = u != 0
+	box = []
+	for axis in xrange(nonzero.ndim):
+		other_axes = tuple(a for a in xrange(nonzero.ndim) if a != axis)
+		indices = np.flatnonzero(nonzero.any(axis=other_axes))
+		if len(indices) == 0:
+			return None
+		box.append(slice(max(indices[0] - 1, 0), indices[-1] + 2))
+	box = tuple(box)
+	return np.pad(nonzero[box], 1, mode='constant'), box, offsets
+
+def _shift(padded, offset):
+	"""View of a padded array shifted by an offset of at most one pixel."""
+	return padded[tuple(slice(1 + o, padded.shape[axis] - 1 + o) for axis, o in enumerate(offset))]
+
+def _line_filter(u, combine, reduce):
+	support = _operator_support(u)
+	res = np.zeros(np.shape(u))
+	if support is None:
+		return res
+	padded, box, offsets = support
+
+	result = None
+	for structure in offsets:
+		line = _shift(padded, structure[0]).copy()
+		for offset in structure[1:]:
+			combine(line, _shift(padded, offset), out=line)
+		if result is None:
+			result = line
+		else:
+			reduce(result, line, out=result)
+	res[box] = result
+	return res
 
-	for i in xrange(len(P)):
-		_aux[i] = binary_dilation(u, P[i])
+def SI(u):
+	"""SI operator: supremum of the erosions of u by the line structuring elements."""
+	return _line_filter(u, np.logical_and, np.logical_or)
 
-	return _aux.min(0)
+def IS(u):
+	"""IS operator: infimum of the dilations of u by the line structuring elements."""
+	return _line_filter(u, np.logical_or, np.logical_and)
+
+def _axis_views(*arrays):
+	"""Views of the arrays with each axis in turn moved first."""
+	for axis in xrange(arrays[0].ndim):
+		yield [np.swapaxes(arr, 0, axis) for arr in arrays]
+
+def gradient_support(u):
+	"""Pixels where np.gradient(u) is non zero along some axis."""
+	support = np.zeros(u.shape, dtype=bool)
+	for v, s in _axis_views(u, support):
+		s[1:-1] |= v[2:] != v[:-2]
+		s[0] |= v[1] != v[0]
+		s[-1] |= v[-1] != v[-2]
+	return support
+
+def label_boundaries(labels):
+	"""Same as find_boundaries(labels): pixels with a face neighbour of another label."""
+	boundaries = np.zeros(labels.shape, dtype=bool)
+	for v, b in _axis_views(labels, boundaries):
+		differ = v[1:] != v[:-1]
+		b[1:] |= differ
+		b[:-1] |= differ
+	return boundaries
 
 # SIoIS operator.
 SIoIS = lambda u: SI(IS(u))
 ISoSI = lambda u: IS(SI(u))
-curvop = fcycle([SIoIS, ISoSI])
 
 class MorphACWE(object):
 	"""Morphological ACWE based on the Chan-Vese energy functional."""
 
-	def __init__(self, data, smoothing=1, lambda1=10, lambda2=1):
+	def __init__(self, data, smoothing=1, lambda1=10, lambda2=1, voronoi_interval=1):
 		"""Create a Morphological ACWE solver.
 
 		Parameters
@@ -118,25 +164,60 @@ class MorphACWE(object):
 		lambda1, lambda2 : scalars
 			Relative importance of the inside pixels (lambda1)
 			against the outside pixels (lambda2).
+		voronoi_interval : int
+			Maximum number of steps between two computations of the
+			Voronoi mask separating the objects. The mask is always
+			recomputed when the number of objects changes. 1 gives
+			the exact evolution.
 		"""
 
 		self._u = None
 		self.smoothing = smoothing
 		self.lambda1 = lambda1
 		self.lambda2 = lambda2
+		self.voronoi_interval = voronoi_interval
+
+		# Each solver alternates SIoIS and ISoSI on its own
+		self.curvop = fcycle([SIoIS, ISoSI])
 
 		self.data = data
 		self.mask = data
+		self._separation = None
 
 	def set_levelset(self, u):
 		self._u = np.double(u)
 		self._u[u > 0] = 1
 		self._u[u <= 0] = 0
 
+		# Running sums of the data inside the contour, for c0 and c1
+		inside = self._u > 0
+		self._data_sum = self.data.sum(dtype=np.float64)
+		self._inside_sum = self.data[inside].sum(dtype=np.float64)
+		self._inside_count = np.count_nonzero(inside)
+		self._separation = None
+
 	levelset = property(lambda self: self._u,
 						set_levelset,
 						doc="The level set embedding function (u).")
 
+	def update_separation(self, u):
+		"""Recompute the Voronoi mask separating the objects of u when the
+		number of objects changed or it is voronoi_interval steps old."""
+		labeled, n_objects = mh.label(u)
+		if (self._separation is not None and n_objects == self._n_objects
+				and self._separation_age < self.voronoi_interval):
+			self._separation_age += 1
+			return self._separation
+
+		mask = mh.segmentation.gvoronoi(labeled)
+		mask = 1-label_boundaries(mask)
+
+		self.mask = np.float32(mask)/np.float32(mask).max()
+		self._separation = mask
+		self._n_objects = n_objects
+		self._separation_age = 1
+		return mask
+
 	def step(self):
 		"""Perform a single step of the morphological Chan-Vese evolution."""
 		# Assign attributes to local variables for convenience.
@@ -148,49 +229,110 @@ class MorphACWE(object):
 		data = self.data
 
 		# Create mask to separate objects
-		labeled, _ = mh.label(u)
-		mask = mh.segmentation.gvoronoi(labeled)
-		mask = 1-find_boundaries(mask)
-
-		self.mask = np.float32(mask)/np.float32(mask).max()
+		mask = self.update_separation(u)
 
 		# Determine c0 and c1.
-		inside = u > 0
-		outside = u <= 0
-		c0 = data[outside].sum() / float(outside.sum())
-		c1 = data[inside].sum() / float(inside.sum())
+		c0 = (self._data_sum - self._inside_sum) / float(data.size - self._inside_count)
+		c1 = self._inside_sum / float(self._inside_count)
 
-		# Image attachment.
-		dres = np.array(np.gradient(u))
-		abs_dres = np.abs(dres).sum(0)
-		aux = abs_dres * (self.lambda1*(data - c1)**2 - self.lambda2*(data - c0)**2)
+		# Image attachment, only where the gradient of u is non zero.
+		band = gradient_support(u)
+		band_data = data[band]
+		aux = self.lambda1*(band_data - c1)**2 - self.lambda2*(band_data - c0)**2
 
 		res = np.copy(u)
-		res[aux < 0] = 1
-		res[aux > 0] = 0
+		band_res = res[band]
+		band_res[aux < 0] = 1
+		band_res[aux > 0] = 0
+		res[band] = band_res
 
 		# Smoothing.
 		for _ in xrange(self.smoothing):
-			res = curvop(res)
+			res = self.curvop(res)
 
 		# Apply mask
 		res *= mask
 
+		grown = (res > 0) & (u <= 0)
+		shrunk = (res <= 0) & (u > 0)
+		self._inside_sum += data[grown].sum(dtype=np.float64) - data[shrunk].sum(dtype=np.float64)
+		self._inside_count += np.count_nonzero(grown) - np.count_nonzero(shrunk)
+
 		self._u = res
 
-	def run(self, iterations):
-		"""Run several iterations of the morphological Chan-Vese method."""
-		for _ in xrange(iterations):
+	def run(self, iterations, tolerance=None, window=4):
+		"""Run several iterations of the morphological Chan-Vese method.
+
+		With a tolerance, stop as soon as at most `tolerance` pixels
+		differ from the level set `window` iterations earlier. The
+		alternating curvature operators usually end in a cycle of two
+		level sets, so the window should be even. On stopping, the level
+		set is the one of the cycle reached at `iterations`, which makes
+		a tolerance of 0 exact.
+		Returns the number of iterations run.
+		"""
+		history = deque([self._u], maxlen=window + 1)
+		for iteration in xrange(1, iterations + 1):
 			self.step()
+			history.append(self._u)
+			if (tolerance is not None and len(history) == window + 1
+					and np.count_nonzero(history[0] != history[-1]) <= tolerance):
+				self.levelset = history[(iterations - iteration) % window]
+				return iteration
+		return iterations
 
-def segment_image_w_morphsnakes(img, nuc_label, num_iters, smoothing=2):
+def segment_image_w_morphsnakes(img, nuc_label, num_iters, smoothing=2, voronoi_interval=1,
+								tolerance=None, window=4, return_iterations=False):
 
-	morph_snake = MorphACWE(img, smoothing=smoothing, lambda1=1, lambda2=1)
+	morph_snake = MorphACWE(img, smoothing=smoothing, lambda1=1, lambda2=1, voronoi_interval=voronoi_interval)
 	morph_snake.levelset = np.float16(nuc_label > 0)
 
-	for _ in xrange(num_iters):
-		morph_snake.step()
+	iterations = morph_snake.run(num_iters, tolerance=tolerance, window=window)
 
 	seg_input = morph_snake.levelset
 	seg = morph.watershed(seg_input, nuc_label, mask=(seg_input > 0))
+	if return_iterations:
+		return seg, iterations
+	return seg
+
+def segment_cells_locally(img, nuc_label, num_iters, smoothing=2, margin=32, voronoi_interval=1,
+							tolerance=None, window=4, return_iterations=False):
+	"""Evolve the active contours of each nucleus on a crop of the frame.
+	Each crop is the bounding box of the nucleus grown by `margin` pixels
+	and starts from all the nuclei it holds, so the cost scales with the
+	area around the cells rather than with the frame. The contours of
+	every crop are split between nuclei by watershed, as for the whole
+	frame, and each crop only writes the cell of its own nucleus. Pixels
+	claimed by several crops go to the cell whose nucleus Voronoi region
+	holds them, or else to the first claimant.
+	# Returns
+		The label image of the cells, labeled as nuc_label, and the largest
+		number of iterations run by a crop when return_iterations is set.
+	"""
+	seg = np.zeros(nuc_label.shape, dtype=np.int64)
+	if nuc_label.max() == 0:
+		return (seg, 0) if return_iterations else seg
+
+	nuclei_regions = mh.segmentation.gvoronoi(nuc_label)
+	max_iterations = 0
+	for index, nucleus_slice in enumerate(find_objects(nuc_label)):
+		if nucleus_slice is None:
+			continue
+		cell_id = index + 1
+		crop = tuple(slice(max(s.start - margin, 0), s.stop + margin) for s in nucleus_slice)
+		crop_label = nuc_label[crop]
+
+		morph_snake = MorphACWE(img[crop], smoothing=smoothing, lambda1=1, lambda2=1, voronoi_interval=voronoi_interval)
+		morph_snake.levelset = np.float16(crop_label > 0)
+		iterations = morph_snake.run(num_iters, tolerance=tolerance, window=window)
+		max_iterations = max(max_iterations, iterations)
+
+		seg_input = morph_snake.levelset
+		cell = morph.watershed(seg_input, crop_label, mask=(seg_input > 0)) == cell_id
+
+		seg_crop = seg[crop]
+		seg_crop[cell & ((seg_crop == 0) | (nuclei_regions[crop] == cell_id))] = cell_id
+
+	if return_iterations:
+		return seg, max_iterations
 	return seg
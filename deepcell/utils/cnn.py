@@ -9,7 +9,9 @@ Functions for building and training convolutional neural networks
 """
 
 import os
+import time
 import datetime
+from collections import deque
 
 import tensorflow as tf
 from keras import backend as K
@@ -213,9 +215,12 @@ def train_model_sample(model=None, dataset=None, optimizer=None,
 	direc_save="/home/vanvalen/ImageAnalysis/DeepCell2/trained_networks/",
 	direc_data="/home/vanvalen/ImageAnalysis/DeepCell2/training_data_npz/",
 	lr_sched = rate_scheduler(lr = 0.01, decay = 0.95),
-	rotation_range=0, flip=True, shear=0, class_weight=None, dist=0):
+	rotation_range=0, rotate_90=False, flip=True, shear=0, class_weight=None, dist=0,
+	workers=0, prefetch=None, cache_dir=None, cache_variants=4, cache_size=None, cache_refresh=None):
 
-	training_data_file_name = os.path.join(direc_data, dataset + ".npz")
+	training_data_file_name = os.path.join(direc_data, dataset)
+	if not os.path.isdir(training_data_file_name):
+		training_data_file_name += ".npz"
 	todays_date = datetime.datetime.now().strftime("%Y-%m-%d")
 
 	file_name_save = os.path.join(direc_save, todays_date + "_" + dataset + "_" + expt + "_" + str(it)  + ".h5")
@@ -264,12 +269,16 @@ def train_model_sample(model=None, dataset=None, optimizer=None,
 	# this will do preprocessing and realtime data augmentation
 	datagen = SampleDataGenerator(
 		rotation_range=rotation_range,  # randomly rotate images by 0 to rotation_range degrees
+		rotate_90=rotate_90,  # randomly rotate images by multiples of 90 degrees
 		shear_range=shear, # randomly shear images in the range (radians , -shear_range to shear_range)
 		horizontal_flip=flip,  # randomly flip images
 		vertical_flip=flip)  # randomly flip images
 
 	# fit the model on the batches generated by datagen.flow()
-	loss_history = model.fit_generator(datagen.sample_flow(train_dict, batch_size=batch_size),
+	# workers > 0 builds the batches in a pool of worker processes
+	loss_history = model.fit_generator(datagen.sample_flow(train_dict, batch_size=batch_size,
+							workers=workers, prefetch=prefetch, cache_dir=cache_dir, cache_variants=cache_variants,
+							cache_size=cache_size, cache_refresh=cache_refresh),
 						steps_per_epoch=len(train_dict["labels"])/batch_size,
 						epochs=n_epoch,
 						validation_data=(X_test, Y_test),
@@ -287,9 +296,11 @@ def train_model_fully_conv(model=None, dataset=None, optimizer=None,
 	direc_save="/home/vanvalen/ImageAnalysis/DeepCell2/trained_networks/",
 	direc_data="/home/vanvalen/ImageAnalysis/DeepCell2/training_data_npz/",
 	lr_sched=rate_scheduler(lr=0.01, decay=0.95),
-	rotation_range=0, flip=True, shear=0, class_weight=None):
+	rotation_range=0, flip=True, shear=0, class_weight=None, workers=0, prefetch=None):
 
-	training_data_file_name = os.path.join(direc_data, dataset + ".npz")
+	training_data_file_name = os.path.join(direc_data, dataset)
+	if not os.path.isdir(training_data_file_name):
+		training_data_file_name += ".npz"
 	todays_date = datetime.datetime.now().strftime("%Y-%m-%d")
 
 	file_name_save = os.path.join(direc_save, todays_date + "_" + dataset + "_" + expt + "_" + str(it)  + ".h5")
@@ -302,6 +313,7 @@ def train_model_fully_conv(model=None, dataset=None, optimizer=None,
 	# the data, shuffled and split between train and test sets
 	print('Training data shape:', train_dict["channels"].shape)
 	print('Training labels shape:', train_dict["labels"].shape)
+	print(len(train_dict["train_ind"]), 'train images')
 
 	print('Testing data shape:', X_test.shape)
 	print('Testing labels shape:', Y_test.shape)
@@ -340,8 +352,9 @@ def train_model_fully_conv(model=None, dataset=None, optimizer=None,
 
 	# loss_history = model.fit(x = [x], y = [y], batch_size = 1, verbose = 1, epochs = 20, callbacks = [ModelCheckpoint(file_name_save, monitor = 'val_loss', verbose = 1, save_best_only = True, mode = 'auto')])
 
-	loss_history = model.fit_generator(datagen.flow(train_dict, batch_size=batch_size),
-						steps_per_epoch=train_dict["labels"].shape[0]/batch_size,
+	loss_history = model.fit_generator(datagen.flow(train_dict, batch_size=batch_size,
+							workers=workers, prefetch=prefetch),
+						steps_per_epoch=len(train_dict["train_ind"])/batch_size,
 						epochs=n_epoch,
 						validation_data=(X_test, Y_test),
 						validation_steps=X_test.shape[0]/batch_size,
@@ -369,56 +382,184 @@ def train_model_fully_conv(model=None, dataset=None, optimizer=None,
 Running convnets
 """
 
-def run_model(image, model, win_x=30, win_y=30, std=False, split=True, process=True):
+class InferenceSession(object):
+	"""Evaluation function of a model, built once and reused for every
+	image, every input shape and every set of weights loaded into the model.
+	# Arguments
+		model: the model to evaluate.
+		callback: optional function called with (input_shape, seconds)
+			after every forward pass.
+		max_timings: number of most recent (input_shape, seconds) pairs
+			kept in `timings`, sessions live as long as their model.
+	"""
+	def __init__(self, model, callback=None, max_timings=100):
+		self.model = model
+		self.callback = callback
+		self.timings = deque(maxlen=max_timings)
+		self._function = None
+
+	def function(self):
+		"""Return the evaluation function of the model, building it on first use."""
+		if self._function is None:
+			self._function = K.function(
+				[self.model.layers[0].input, K.learning_phase()],
+				[self.model.layers[-1].output])
+		return self._function
+
+	def predict(self, x):
+		"""Run the model in test mode on a batch and record the time it took."""
+		evaluate_model = self.function()
+		start = time.time()
+		output = evaluate_model([x, 0])[0]
+		elapsed = time.time() - start
+		self.timings.append((x.shape, elapsed))
+		if self.callback is not None:
+			self.callback(x.shape, elapsed)
+		return output
+
+def get_inference_session(model):
+	"""Return the InferenceSession of a model, creating it on first use."""
+	session = getattr(model, '_inference_session', None)
+	if session is None:
+		session = InferenceSession(model)
+		model._inference_session = session
+	return session
+
+def _tile_starts(valid_size, tile_size):
+	# Tiles are laid edge to edge, the last one is moved back against the far edge
+	starts = range(0, valid_size - tile_size + 1, tile_size)
+	if starts[-1] + tile_size < valid_size:
+		starts += [valid_size - tile_size]
+	return starts
+
+def run_model_tiled(image, model, win_x=30, win_y=30, tile_size=None, batch_size=4):
+	"""Run a fully convolutional model over an image in overlapping tiles.
+	Tiles overlap by the receptive field radius (win_x, win_y), so that the
+	stitched output is the same as that of the whole image in one pass,
+	while memory only depends on the tile size.
+	# Arguments
+		image: array of shape (1, n_channels, size_x, size_y).
+		model: a dilated network whose output is the input cropped by (win_x, win_y).
+		tile_size: (tile_x, tile_y) input size of the tiles, defaults to the
+			input shape of the model.
+		batch_size: number of tiles per forward pass, ignored if the model
+			has a fixed batch size.
+	# Returns
+		The model output of shape (n_features, size_x, size_y), zero on the borders.
+	"""
+	if tile_size is None:
+		tile_size = model.input_shape[2:]
+	tile_x, tile_y = tile_size
+	out_x, out_y = tile_x - 2*win_x, tile_y - 2*win_y
+	if model.input_shape[0] is not None:
+		batch_size = model.input_shape[0]
+
+	size_x, size_y = image.shape[2:]
+
+	# Images smaller than a tile are padded on their far edges
+	pad_x, pad_y = max(tile_x - size_x, 0), max(tile_y - size_y, 0)
+	if pad_x or pad_y:
+		image = np.pad(image, ((0, 0), (0, 0), (0, pad_x), (0, pad_y)), mode='constant')
+	valid_x, valid_y = image.shape[2] - 2*win_x, image.shape[3] - 2*win_y
+
+	corners = [(i, j) for i in _tile_starts(valid_x, out_x) for j in _tile_starts(valid_y, out_y)]
+
+	session = get_inference_session(model)
+
+	n_features = model.layers[-1].output_shape[1]
+	model_output = np.zeros((n_features, valid_x, valid_y), dtype='float32')
+
+	tiles = np.zeros((batch_size, image.shape[1], tile_x, tile_y), dtype=image.dtype)
+	for start in xrange(0, len(corners), batch_size):
+		batch_corners = corners[start:start + batch_size]
+		for k, (i, j) in enumerate(batch_corners):
+			tiles[k] = image[0, :, i:i + tile_x, j:j + tile_y]
+		if model.input_shape[0] is None:
+			outputs = session.predict(tiles[:len(batch_corners)])
+		else:
+			outputs = session.predict(tiles)
+		for k, (i, j) in enumerate(batch_corners):
+			model_output[:, i:i + out_x, j:j + out_y] = outputs[k]
+
+	model_output = model_output[:, :size_x - 2*win_x, :size_y - 2*win_y]
+	model_output = np.pad(model_output, pad_width=((0, 0), (win_x, win_x), (win_y, win_y)), mode='constant', constant_values=0)
+	return model_output
+
+def run_model(image, model, win_x=30, win_y=30, std=False, split=True, process=True, tile_size=None, batch_size=4):
 	if process:
 		for j in xrange(image.shape[1]):
 			image[0, j, :, :] = process_image(image[0, j, :, :], win_x, win_y, std)
 
 	if split:
-		image_size_x = image.shape[2]/2
-		image_size_y = image.shape[3]/2
-	else:
-		image_size_x = image.shape[2]
-		image_size_y = image.shape[3]
+		return run_model_tiled(image, model, win_x=win_x, win_y=win_y, tile_size=tile_size, batch_size=batch_size)
 
-	evaluate_model = K.function(
-		[model.layers[0].input, K.learning_phase()],
-		[model.layers[-1].output])
+	model_output = get_inference_session(model).predict(image)
+	model_output = model_output[0, :, :, :]
 
-	n_features = model.layers[-1].output_shape[1]
+	model_output = np.pad(model_output, pad_width=((0, 0), (win_x, win_x), (win_y, win_y)), mode='constant', constant_values=0)
+	return model_output
 
-	if split:
-		model_output = np.zeros((n_features, 2*image_size_x-win_x*2, 2*image_size_y-win_y*2), dtype='float32')
+def run_patch_model(image, model, win_x=30, win_y=30, std=False, process=True, mask=None, batch_size=4096):
+	"""Run a patch classifier on every window of an image, one output per pixel.
+	Windows are read from a strided view of the image and copied one batch
+	at a time, so memory is bounded by the batch size.
+	# Arguments
+		image: array of shape (1, n_channels, size_x, size_y).
+		model: a patch model such as bn_feature_net_61x61.
+		mask: optional boolean array of shape (size_x, size_y), only the
+			pixels where it is True are evaluated.
+		batch_size: number of windows per forward pass.
+	# Returns
+		The model output of shape (n_features, size_x, size_y), zero on the
+		borders and outside of the mask.
+	"""
+	if process:
+		for j in xrange(image.shape[1]):
+			image[0, j, :, :] = process_image(image[0, j, :, :], win_x, win_y, std)
 
-		img_0 = image[:, :, 0:image_size_x+win_x, 0:image_size_y+win_y]
-		img_1 = image[:, :, 0:image_size_x+win_x, image_size_y-win_y:]
-		img_2 = image[:, :, image_size_x-win_x:, 0:image_size_y+win_y]
-		img_3 = image[:, :, image_size_x-win_x:, image_size_y-win_y:]
+	size_x, size_y = image.shape[2:]
 
-		model_output[:, 0:image_size_x-win_x, 0:image_size_y-win_y] = evaluate_model([img_0, 0])[0]
-		model_output[:, 0:image_size_x-win_x, image_size_y-win_y:] = evaluate_model([img_1, 0])[0]
-		model_output[:, image_size_x-win_x:, 0:image_size_y-win_y] = evaluate_model([img_2, 0])[0]
-		model_output[:, image_size_x-win_x:, image_size_y-win_y:] = evaluate_model([img_3, 0])[0]
+	# (size_x - 2*win_x, size_y - 2*win_y, n_channels, 2*win_x + 1, 2*win_y + 1) view of the windows
+	windows = np.moveaxis(sliding_window_view(image[0], win_x, win_y), 0, 2)
 
+	if mask is None:
+		valid_pixels = np.ones(windows.shape[:2], dtype='bool')
 	else:
-		model_output = evaluate_model([image, 0])[0]
-		model_output = model_output[0, :, :, :]
+		valid_pixels = mask[win_x:size_x - win_x, win_y:size_y - win_y]
+	pixels_x, pixels_y = np.nonzero(valid_pixels)
+
+	session = get_inference_session(model)
+	n_features = model.layers[-1].output_shape[-1]
+	model_output = np.zeros((n_features, size_x, size_y), dtype='float32')
+
+	for start in xrange(0, len(pixels_x), batch_size):
+		batch_x = pixels_x[start:start + batch_size]
+		batch_y = pixels_y[start:start + batch_size]
+		output = session.predict(windows[batch_x, batch_y])
+		model_output[:, batch_x + win_x, batch_y + win_y] = output.T
 
-	model_output = np.pad(model_output, pad_width=((0, 0), (win_x, win_x), (win_y, win_y)), mode='constant', constant_values=0)
 	return model_output
 
 def run_model_on_directory(data_location, channel_names, output_location, model, win_x=30, win_y=30,
-							std=False, split=True, process=True, save=True):
+							std=False, split=True, process=True, save=True, cache_dir=None, cache_size=None,
+							tile_size=None, batch_size=4):
 
 	n_features = model.layers[-1].output_shape[1]
 	counter = 0
 
-	image_list = get_images_from_directory(data_location, channel_names)
+	# Normalized images can be reused from the preprocessing cache
+	if process and cache_dir is not None:
+		image_list = get_processed_images_from_directory(data_location, channel_names, win_x=win_x, win_y=win_y,
+							std=std, cache_dir=cache_dir, cache_size=cache_size)
+		process = False
+	else:
+		image_list = get_images_from_directory(data_location, channel_names)
 	processed_image_list = []
 
 	for image in image_list:
 		print("Processing image " + str(counter + 1) + " of " + str(len(image_list)))
-		processed_image = run_model(image, model, win_x=win_x, win_y=win_y, std=std, split=split, process=process)
+		processed_image = run_model(image, model, win_x=win_x, win_y=win_y, std=std, split=split, process=process,
+							tile_size=tile_size, batch_size=batch_size)
 		processed_image_list += [processed_image]
 
 		# Save images
@@ -433,9 +574,13 @@ def run_model_on_directory(data_location, channel_names, output_location, model,
 
 def run_models_on_directory(data_location, channel_names, output_location, model_fn, list_of_weights,
 							n_features=3, image_size_x=1080, image_size_y=1280, win_x=30, win_y=30,
-							std=False, split=True, process=True, save=True):
+							std=False, split=True, process=True, save=True, cache_dir=None, cache_size=None,
+							tile_size=None, batch_size=4):
 
-	if split:
+	# With split, the model is built at the tile size and run over overlapping tiles
+	if split and tile_size is not None:
+		input_shape = (len(channel_names),) + tuple(tile_size)
+	elif split:
 		input_shape = (len(channel_names), image_size_x/2+win_x, image_size_y/2+win_y)
 	else:
 		input_shape = (len(channel_names), image_size_x, image_size_y)
@@ -444,25 +589,42 @@ def run_models_on_directory(data_location, channel_names, output_location, model
 
 	n_features = model.layers[-1].output_shape[1]
 
-	model_outputs = []
+	# Each weight file is read once, and swapped into the model for every image
+	ensemble_weights = []
 	for weights_path in list_of_weights:
 		print(weights_path)
 		model.load_weights(weights_path)
-		processed_image_list = run_model_on_directory(data_location, channel_names, output_location,
-							model, win_x=win_x, win_y=win_y, save=False, std=std,
-							split=split, process=process)
-		model_outputs += [np.stack(processed_image_list, axis=0)]
-
-	# Average all images
-	model_output = np.stack(model_outputs, axis=0)
-	model_output = np.mean(model_output, axis=0)
-
-	# Save images
-	if save:
-		for img in xrange(model_output.shape[0]):
+		ensemble_weights += [model.get_weights()]
+
+	# Each image is read and normalized once for the whole ensemble
+	if process:
+		image_list = get_processed_images_from_directory(data_location, channel_names, win_x=win_x, win_y=win_y,
+							std=std, cache_dir=cache_dir, cache_size=cache_size)
+	else:
+		image_list = get_images_from_directory(data_location, channel_names)
+
+	model_output = []
+	for img, image in enumerate(image_list):
+		print("Processing image " + str(img + 1) + " of " + str(len(image_list)))
+
+		# Running mean of the ensemble outputs
+		mean_output = None
+		for member, weights in enumerate(ensemble_weights):
+			model.set_weights(weights)
+			output = run_model(image, model, win_x=win_x, win_y=win_y, std=std, split=split, process=False,
+							batch_size=batch_size)
+			if mean_output is None:
+				mean_output = output.astype('float64')
+			else:
+				mean_output += (output - mean_output) / (member + 1)
+		mean_output = mean_output.astype('float32')
+		model_output += [mean_output]
+
+		# Save images
+		if save:
 			for feat in xrange(n_features):
-				feature = model_output[img, feat, :, :]
+				feature = mean_output[feat, :, :]
 				cnnout_name = os.path.join(output_location, 'feature_' + str(feat) + "_frame_" + str(img) + r'.tif')
 				tiff.imsave(cnnout_name, feature)
 
-	return model_output
+	return np.stack(model_output, axis=0)
@@ -9,7 +9,9 @@ Functions for making training data
 """
 
 import os
+import shutil
 import fnmatch
+import tempfile
 
 import numpy as np
 
@@ -28,9 +30,157 @@ from .helper import *
 Functions to create training data
 """
 
+def sample_pixels(feature_mask, window_size_x, window_size_y, max_num_of_pixels=np.Inf):
+	"""Randomly sample training pixels from the feature masks of one training set.
+	# Arguments
+		feature_mask: array of shape (num_of_features + 1, image_size_x, image_size_y).
+		window_size_x, window_size_y: half sizes of the training window. Only pixels
+			whose window lies strictly inside the image are sampled.
+		max_num_of_pixels: maximum number of pixels drawn from each feature.
+	# Returns
+		The rows, cols and feature labels of the sampled pixels as int32 arrays.
+	"""
+	image_size_x, image_size_y = feature_mask.shape[1:]
+
+	# Mask of the pixels whose window fits in the image
+	border_valid = np.zeros((image_size_x, image_size_y), dtype='bool')
+	border_valid[window_size_x+1:image_size_x-window_size_x, window_size_y+1:image_size_y-window_size_y] = True
+
+	candidates = feature_mask == 1
+	candidates &= border_valid
+	labels, rows, cols = np.nonzero(candidates)
+
+	if np.isfinite(max_num_of_pixels):
+		# Shuffle the candidates within each feature and keep the first
+		# max_num_of_pixels of every feature
+		order = np.lexsort((np.random.random(len(labels)), labels))
+		labels = labels[order]
+		rows = rows[order]
+		cols = cols[order]
+		rank = np.arange(len(labels)) - np.searchsorted(labels, labels)
+		keep = rank < max_num_of_pixels
+
+		labels = labels[keep]
+		rows = rows[keep]
+		cols = cols[keep]
+
+	return rows.astype('int32'), cols.astype('int32'), labels.astype('int32')
+
+def load_training_channels(direc_path, channel_names, image_size_x, image_size_y, window_size_x=30, window_size_y=30,
+		process_std=False, process_remove_zeros=False):
+	"""Load and normalize the channel images of one training directory.
+	# Returns
+		A float32 array of shape (num_channels, image_size_x, image_size_y).
+	"""
+	imglist = os.listdir(direc_path)
+	channels = np.zeros((len(channel_names), image_size_x, image_size_y), dtype='float32')
+
+	for channel_counter, channel in enumerate(channel_names):
+		for img in imglist:
+			if fnmatch.fnmatch(img, r'*' + channel + r'*'):
+				channel_file = os.path.join(direc_path, img)
+				channel_img = np.asarray(get_image(channel_file), dtype=K.floatx())
+				channel_img = process_image(channel_img, window_size_x, window_size_y,
+									std=process_std, remove_zeros=process_remove_zeros)
+				channels[channel_counter, :, :] = channel_img
+
+	return channels
+
+def load_feature_mask(direc_path, image_size_x, image_size_y, num_of_features=2, edge_feature=[1, 0, 0], dilation_radius=1):
+	"""Load the feature masks of one training directory and compute the background mask.
+	# Returns
+		An array of shape (num_of_features + 1, image_size_x, image_size_y).
+	"""
+	imglist = os.listdir(direc_path)
+	feature_mask = np.zeros((num_of_features + 1, image_size_x, image_size_y))
+
+	for j in xrange(num_of_features):
+		feature_name = "feature_" + str(j) + r".*"
+		for img in imglist:
+			if fnmatch.fnmatch(img, feature_name):
+				feature_file = os.path.join(direc_path, img)
+				feature_img = get_image(feature_file)
+
+				if np.sum(feature_img) > 0:
+					feature_img /= np.amax(feature_img)
+
+				if edge_feature[j] == 1 and dilation_radius is not None:
+					strel = sk.morphology.disk(dilation_radius)
+					feature_img = sk.morphology.binary_dilation(feature_img, selem=strel)
+
+				feature_mask[j, :, :] = feature_img
+
+	# Thin the augmented edges by subtracting the interior features.
+	for j in xrange(num_of_features):
+		if edge_feature[j] == 1:
+			for k in xrange(num_of_features):
+				if edge_feature[k] == 0:
+					feature_mask[j, :, :] -= feature_mask[k, :, :]
+			feature_mask[j, :, :] = feature_mask[j, :, :] > 0
+
+	# Compute the mask for the background
+	feature_mask_sum = np.sum(feature_mask, axis=0)
+	feature_mask[num_of_features, :, :] = 1 - feature_mask_sum
+
+	return feature_mask
+
+def count_edge_pixels(feature_mask, edge_feature, trim_x, trim_y):
+	"""Count the edge pixels of one training set inside the trimmed image."""
+	feature_mask_trimmed = feature_mask[:, trim_x:-trim_x, trim_y:-trim_y]
+	list_of_edge_pixel_numbers = []
+	for k, edge_feat in enumerate(edge_feature):
+		if edge_feat == 1:
+			list_of_edge_pixel_numbers += [np.sum(feature_mask_trimmed[k, :, :])]
+	return list_of_edge_pixel_numbers
+
+def save_sampled_pixels(store_direc, direc_counter, rows, cols, labels):
+	"""Append the pixels sampled from one training set to the on-disk store."""
+	pixels_file = os.path.join(store_direc, 'pixels_' + str(direc_counter) + '.npy')
+	np.save(pixels_file, np.stack([rows, cols, labels], axis=0))
+	return len(rows)
+
+def load_sampled_pixels(store_direc, num_of_pixels, max_training_examples=1e7):
+	"""Gather the pixels stored by save_sampled_pixels, randomly selecting
+	max_training_examples of them if there are too many.
+	# Returns
+		The rows, cols, batch and labels of the selected pixels.
+	"""
+	total_num_of_pixels = np.sum(num_of_pixels)
+
+	# Randomly select training points if there are too many
+	selected = None
+	if total_num_of_pixels > max_training_examples:
+		selected = np.random.choice(total_num_of_pixels, size=int(max_training_examples), replace=False)
+		selected = np.sort(selected)
+
+	feature_rows = []
+	feature_cols = []
+	feature_batch = []
+	feature_label = []
+
+	offset = 0
+	for direc_counter, num in enumerate(num_of_pixels):
+		pixels = np.load(os.path.join(store_direc, 'pixels_' + str(direc_counter) + '.npy'))
+		if selected is not None:
+			start, stop = np.searchsorted(selected, [offset, offset + num])
+			pixels = pixels[:, selected[start:stop] - offset]
+		offset += num
+
+		feature_rows += [pixels[0]]
+		feature_cols += [pixels[1]]
+		feature_batch += [np.full(pixels.shape[1], direc_counter, dtype='int32')]
+		feature_label += [pixels[2]]
+
+	feature_rows = np.concatenate(feature_rows)
+	feature_cols = np.concatenate(feature_cols)
+	feature_batch = np.concatenate(feature_batch)
+	feature_label = np.concatenate(feature_label)
+
+	return feature_rows, feature_cols, feature_batch, feature_label
+
 def make_training_data_sample(max_training_examples=1e7, window_size_x=30, window_size_y=30,
 		direc_name="/home/vanvalen/Data/RAW_40X_tube",
-		file_name_save=os.path.join("/home/vanvalen/DeepCell/training_data_npz/RAW40X_tube/", "RAW_40X_tube_61x61.npz"),
+		file_name_save=os.path.join("/home/vanvalen/DeepCell/training_data_npz/RAW40X_tube/", "RAW_40X_tube_61x61"),
 		training_direcs=["set2/", "set3/", "set4/", "set5/", "set6/"],
 		channel_names=["channel004", "channel001"],
 		num_of_features=2,
@@ -52,129 +202,66 @@ def make_training_data_sample(max_training_examples=1e7, window_size_x=30, windo
 	# Load one file to get image sizes
 	image_size_x, image_size_y = get_image_sizes(os.path.join(direc_name, training_direcs[0]), channel_names)
 
-	# Initialize arrays for the training images and the feature masks
-	channels = np.zeros((num_direcs, num_channels, image_size_x, image_size_y), dtype='float32')
-	feature_mask = np.zeros((num_direcs, num_of_features + 1, image_size_x, image_size_y))
-
-	# Load training images
-	for direc_counter, direc in enumerate(training_direcs):
-		imglist = os.listdir(os.path.join(direc_name, direc))
-		channel_counter = 0
-
-		# Load channels
-		for channel_counter, channel in enumerate(channel_names):
-			for img in imglist:
-				if fnmatch.fnmatch(img, r'*' + channel + r'*'):
-					channel_file = os.path.join(direc_name, direc, img)
-					channel_img = np.asarray(get_image(channel_file), dtype=K.floatx())
-					channel_img = process_image(channel_img, window_size_x, window_size_y,
-										std=process_std, remove_zeros=process_remove_zeros)
-					channels[direc_counter, channel_counter, :, :] = channel_img
-
-		# Load feature mask
-		for j in xrange(num_of_features):
-			feature_name = "feature_" + str(j) + r".*"
-			for img in imglist:
-				if fnmatch.fnmatch(img, feature_name):
-					feature_file = os.path.join(direc_name, direc, img)
-					feature_img = get_image(feature_file)
-
-					if np.sum(feature_img) > 0:
-						feature_img /= np.amax(feature_img)
-
-					if edge_feature[j] == 1 and dilation_radius is not None:
-						strel = sk.morphology.disk(dilation_radius)
-						feature_img = sk.morphology.binary_dilation(feature_img, selem=strel)
-
-					feature_mask[direc_counter, j, :, :] = feature_img
-
-		# Thin the augmented edges by subtracting the interior features.
-		for j in xrange(num_of_features):
-			if edge_feature[j] == 1:
-				for k in xrange(num_of_features):
-					if edge_feature[k] == 0:
-						feature_mask[direc_counter, j, :, :] -= feature_mask[direc_counter, k, :, :]
-				feature_mask[direc_counter, j, :, :] = feature_mask[direc_counter, j, :, :] > 0
-
-		# Compute the mask for the background
-		feature_mask_sum = np.sum(feature_mask[direc_counter, :, :, :], axis=0)
-		feature_mask[direc_counter, num_of_features, :, :] = 1 - feature_mask_sum
-
-	# Find out how many example pixels exist for each feature and select the feature
-	# the fewest examples
-	feature_mask_trimmed = feature_mask[:, :, window_size_x+1:-window_size_x-1, window_size_y+1:-window_size_y-1]
-	feature_rows = []
-	feature_cols = []
-	feature_batch = []
-	feature_label = []
-
-	# We need to find the training data set with the least number of edge pixels. We will then sample
-	# that number of pixels from each of the training data sets (if possible)
-
-	list_of_edge_pixel_numbers = []
-	for j in xrange(feature_mask_trimmed.shape[0]):
-		for k, edge_feat in enumerate(edge_feature):
-			if edge_feat == 1:
-				list_of_edge_pixel_numbers += [np.sum(feature_mask_trimmed[j, k, :, :])]
-	if sub_sample:
-		max_num_of_pixels = max(list_of_edge_pixel_numbers)
-	else:
-		max_num_of_pixels = np.Inf
-
-	print(channels.shape)
-	print(feature_mask_trimmed.shape)
-	for direc in xrange(channels.shape[0]):
-		for k in xrange(num_of_features + 1):
-			pixel_counter = 0
-			feature_rows_temp, feature_cols_temp = np.where(feature_mask[direc, k, :, :] == 1)
-
-			# Check to make sure the features are actually present
-			if len(feature_rows_temp) > 0:
-				# Randomly permute index vector
-				non_rand_ind = np.arange(len(feature_rows_temp))
-				rand_ind = np.random.choice(non_rand_ind, size=len(feature_rows_temp), replace=False)
-
-				for i in rand_ind:
-					if pixel_counter < max_num_of_pixels:
-						if ((feature_rows_temp[i] - window_size_x > 0) and (feature_rows_temp[i] + window_size_x < image_size_x)
-								and (feature_cols_temp[i] - window_size_y > 0) and (feature_cols_temp[i] + window_size_y < image_size_y)):
-							feature_rows += [feature_rows_temp[i]]
-							feature_cols += [feature_cols_temp[i]]
-							feature_batch += [direc]
-							feature_label += [k]
-							pixel_counter += 1
-
-	feature_rows = np.array(feature_rows, dtype='int32')
-	feature_cols = np.array(feature_cols, dtype='int32')
-	feature_batch = np.array(feature_batch, dtype='int32')
-	feature_label = np.array(feature_label, dtype='int32')
-
-
-	# Randomly select training points if there are too many
-	if len(feature_rows) > max_training_examples:
+	# The training images and the sampled pixels are streamed to the training data
+	# directory one training directory at a time, so only one image set is held in memory.
+	if not os.path.isdir(file_name_save):
+		os.makedirs(file_name_save)
+	store_direc = tempfile.mkdtemp(dir=file_name_save)
+	try:
+		channels = np.lib.format.open_memmap(os.path.join(file_name_save, 'channels.npy'), mode='w+',
+							dtype='float32', shape=(num_direcs, num_channels, image_size_x, image_size_y))
+
+		# We need to find the training data set with the least number of edge pixels. We will then sample
+		# that number of pixels from each of the training data sets (if possible)
+		if sub_sample:
+			list_of_edge_pixel_numbers = []
+			for direc in training_direcs:
+				feature_mask = load_feature_mask(os.path.join(direc_name, direc), image_size_x, image_size_y,
+								num_of_features=num_of_features, edge_feature=edge_feature, dilation_radius=dilation_radius)
+				list_of_edge_pixel_numbers += count_edge_pixels(feature_mask, edge_feature, window_size_x+1, window_size_y+1)
+			max_num_of_pixels = max(list_of_edge_pixel_numbers)
+		else:
+			max_num_of_pixels = np.Inf
+
+		print(channels.shape)
+		num_of_pixels = []
+		for direc_counter, direc in enumerate(training_direcs):
+			direc_path = os.path.join(direc_name, direc)
+
+			# Load training images
+			channels[direc_counter, :, :, :] = load_training_channels(direc_path, channel_names, image_size_x, image_size_y,
+								window_size_x=window_size_x, window_size_y=window_size_y,
+								process_std=process_std, process_remove_zeros=process_remove_zeros)
+
+			# Load feature mask and sample pixels
+			feature_mask = load_feature_mask(direc_path, image_size_x, image_size_y,
+								num_of_features=num_of_features, edge_feature=edge_feature, dilation_radius=dilation_radius)
+			rows, cols, labels = sample_pixels(feature_mask, window_size_x, window_size_y,
+											max_num_of_pixels=max_num_of_pixels)
+			num_of_pixels += [save_sampled_pixels(store_direc, direc_counter, rows, cols, labels)]
+
+		channels.flush()
+
+		feature_rows, feature_cols, feature_batch, feature_label = load_sampled_pixels(store_direc, num_of_pixels,
+								max_training_examples=max_training_examples)
+
+		# Compute weights for each class
+		weights = class_weight.compute_class_weight('balanced', classes=np.unique(feature_label), y=feature_label)
+
+		# Randomize
 		non_rand_ind = np.arange(len(feature_rows), dtype='int')
-		rand_ind = np.random.choice(non_rand_ind, size=max_training_examples, replace=False)
+		rand_ind = np.random.choice(non_rand_ind, size=len(feature_rows), replace=False)
 
 		feature_rows = feature_rows[rand_ind]
 		feature_cols = feature_cols[rand_ind]
 		feature_batch = feature_batch[rand_ind]
 		feature_label = feature_label[rand_ind]
 
-	# Compute weights for each class
-	weights = class_weight.compute_class_weight('balanced', classes=np.unique(feature_label), y=feature_label)
-
-	# Randomize
-	non_rand_ind = np.arange(len(feature_rows), dtype='int')
-	rand_ind = np.random.choice(non_rand_ind, size=len(feature_rows), replace=False)
-
-	feature_rows = feature_rows[rand_ind]
-	feature_cols = feature_cols[rand_ind]
-	feature_batch = feature_batch[rand_ind]
-	feature_label = feature_label[rand_ind]
-
-	# Save training data in npz format
-	np.savez(file_name_save, weights=weights, channels=channels, y=feature_label, batch=feature_batch,
-			pixels_x=feature_rows, pixels_y=feature_cols, win_x=window_size_x, win_y=window_size_y)
+		# Save training data as memory-mappable arrays
+		save_training_data(file_name_save, window_size_x, window_size_y, weights=weights, channels=channels,
+				y=feature_label, batch=feature_batch, pixels_x=feature_rows, pixels_y=feature_cols)
+	finally:
+		shutil.rmtree(store_direc)
 
 	if display:
 		_, ax = plt.subplots(len(training_direcs), num_of_features+2, squeeze=False)
@@ -187,8 +274,10 @@ def make_training_data_sample(max_training_examples=1e7, window_size_x=30, windo
 			ax[j, 0].axes.get_xaxis().set_visible(False)
 			ax[j, 0].axes.get_yaxis().set_visible(False)
 
+			feature_mask = load_feature_mask(os.path.join(direc_name, training_direcs[j]), image_size_x, image_size_y,
+							num_of_features=num_of_features, edge_feature=edge_feature, dilation_radius=dilation_radius)
 			for k in xrange(1, num_of_features+2):
-				ax[j, k].imshow(feature_mask[j, k-1, :, :], cmap=plt.cm.gray, interpolation='nearest')
+				ax[j, k].imshow(feature_mask[k-1, :, :], cmap=plt.cm.gray, interpolation='nearest')
 				ax[j, k].axes.get_xaxis().set_visible(False)
 				ax[j, k].axes.get_yaxis().set_visible(False)
 		plt.show()
@@ -201,7 +290,7 @@ def make_training_data_sample(max_training_examples=1e7, window_size_x=30, windo
 
 def make_training_data_fully_conv(max_training_examples=1e7, window_size_x=30, window_size_y=30,
 		direc_name='/home/vanvalen/Data/RAW_40X_tube',
-		file_name_save=os.path.join('/home/vanvalen/DeepCell/training_data_npz/RAW40X_tube/', 'RAW_40X_tube_61x61.npz'),
+		file_name_save=os.path.join('/home/vanvalen/DeepCell/training_data_npz/RAW40X_tube/', 'RAW_40X_tube_61x61'),
 		training_direcs=["set2/", "set3/", "set4/", "set5/", "set6/"],
 		channel_names=["channel004", "channel001"],
 		num_of_features=2,
@@ -220,130 +309,78 @@ def make_training_data_fully_conv(max_training_examples=1e7, window_size_x=30, w
 	# Load one file to get image sizes
 	image_size_x, image_size_y = get_image_sizes(os.path.join(direc_name, training_direcs[0]), channel_names)
 
-	# Initialize arrays for the training images and the feature masks
-	channels = np.zeros((num_direcs, num_channels, image_size_x, image_size_y), dtype='float32')
-	feature_mask = np.zeros((num_direcs, num_of_features + 1, image_size_x, image_size_y))
-
-	# Load training images
-	for direc_counter, direc in enumerate(training_direcs):
-		imglist = os.listdir(os.path.join(direc_name, direc))
-		channel_counter = 0
-
-		# Load channels
-		for channel_counter, channel in enumerate(channel_names):
-			for img in imglist:
-				if fnmatch.fnmatch(img, r'*' + channel + r'*'):
-					channel_file = os.path.join(direc_name, direc, img)
-					channel_img = get_image(channel_file)
-					channel_img = process_image(channel_img, window_size_x, window_size_y)
-					channels[direc_counter, channel_counter, :, :] = channel_img
-
-		# Load feature mask
-		for j in xrange(num_of_features):
-			feature_name = "feature_" + str(j) + r".*"
-			for img in imglist:
-				if fnmatch.fnmatch(img, feature_name):
-					feature_file = os.path.join(direc_name, direc, img)
-					feature_img = get_image(feature_file)
-
-					if np.sum(feature_img) > 0:
-						feature_img /= np.amax(feature_img)
-
-					if edge_feature[j] == 1 and dilation_radius is not None:
-						strel = sk.morphology.disk(dilation_radius)
-						feature_img = sk.morphology.binary_dilation(feature_img, selem=strel)
-
-					feature_mask[direc_counter, j, :, :] = feature_img
-
-		# Thin the augmented edges by subtracting the interior features.
-		for j in xrange(num_of_features):
-			if edge_feature[j] == 1:
-				for k in xrange(num_of_features):
-					if edge_feature[k] == 0:
-						feature_mask[direc_counter, j, :, :] -= feature_mask[direc_counter, k, :, :]
-				feature_mask[direc_counter, j, :, :] = feature_mask[direc_counter, j, :, :] > 0
-
-		# Compute the mask for the background
-		feature_mask_sum = np.sum(feature_mask[direc_counter, :, :, :], axis=0)
-		feature_mask[direc_counter, num_of_features, :, :] = 1 - feature_mask_sum
-		feature_mask_trimmed = feature_mask[:, :, window_size_x:-window_size_x, window_size_y:-window_size_y]
-
-		# Create annotation of the training data in one image
-		feature_label = np.zeros((feature_mask_trimmed.shape[0],) + (feature_mask_trimmed.shape[2:]))
-		for batch in xrange(feature_mask_trimmed.shape[0]):
-			for feature in xrange(feature_mask_trimmed.shape[1]):
-				feature_label[batch, :, :] += feature * feature_mask_trimmed[batch, feature, :, :]
-
-	feature_rows = []
-	feature_cols = []
-	feature_batch = []
-
-	# We need to find the training data set with the least number of edge pixels. We will then sample
-	# that number of pixels from each of the training data sets (if possible)
-
-	list_of_edge_pixel_numbers = []
-	for j in xrange(feature_mask_trimmed.shape[0]):
-		for k, edge_feat in enumerate(edge_feature):
-			if edge_feat == 1:
-				list_of_edge_pixel_numbers += [np.sum(feature_mask_trimmed[j, k, :, :])]
-	if sub_sample:
-		max_num_of_pixels = max(list_of_edge_pixel_numbers)
-	else:
-		max_num_of_pixels = np.Inf
-
-	print(channels.shape)
-	print(feature_mask_trimmed.shape)
-	for direc in xrange(channels.shape[0]):
-		for k in xrange(num_of_features + 1):
-			pixel_counter = 0
-			feature_rows_temp, feature_cols_temp = np.where(feature_mask[direc, k, :, :] == 1)
-
-			# Check to make sure the features are actually present
-			if len(feature_rows_temp) > 0:
-				# Randomly permute index vector
-				non_rand_ind = np.arange(len(feature_rows_temp))
-				rand_ind = np.random.choice(non_rand_ind, size=len(feature_rows_temp), replace=False)
-
-				for i in rand_ind:
-					if pixel_counter < max_num_of_pixels:
-						if ((feature_rows_temp[i] - window_size_x > 0) and (feature_rows_temp[i] + window_size_x < image_size_x)
-								and (feature_cols_temp[i] - window_size_y > 0) and (feature_cols_temp[i] + window_size_y < image_size_y)):
-							feature_rows += [feature_rows_temp[i]]
-							feature_cols += [feature_cols_temp[i]]
-							feature_batch += [direc]
-							pixel_counter += 1
-
-	feature_rows = np.array(feature_rows, dtype='int32')
-	feature_cols = np.array(feature_cols, dtype='int32')
-	feature_batch = np.array(feature_batch, dtype='int32')
-
-
-	# Randomly select training points if there are too many
-	if len(feature_rows) > max_training_examples:
+	# The training images and the feature masks are streamed to the training data
+	# directory one training directory at a time, so only one image set is held in memory.
+	if not os.path.isdir(file_name_save):
+		os.makedirs(file_name_save)
+	store_direc = tempfile.mkdtemp(dir=file_name_save)
+	try:
+		channels = np.lib.format.open_memmap(os.path.join(file_name_save, 'channels.npy'), mode='w+',
+							dtype='float32', shape=(num_direcs, num_channels, image_size_x, image_size_y))
+		feature_mask = np.lib.format.open_memmap(os.path.join(file_name_save, 'y.npy'), mode='w+',
+							dtype='float64', shape=(num_direcs, num_of_features + 1, image_size_x, image_size_y))
+
+		# Load training images
+		list_of_edge_pixel_numbers = []
+		label_counts = {}
+		for direc_counter, direc in enumerate(training_direcs):
+			direc_path = os.path.join(direc_name, direc)
+			channels[direc_counter, :, :, :] = load_training_channels(direc_path, channel_names, image_size_x, image_size_y,
+								window_size_x=window_size_x, window_size_y=window_size_y)
+			feature_mask[direc_counter, :, :, :] = load_feature_mask(direc_path, image_size_x, image_size_y,
+								num_of_features=num_of_features, edge_feature=edge_feature, dilation_radius=dilation_radius)
+
+			list_of_edge_pixel_numbers += count_edge_pixels(feature_mask[direc_counter], edge_feature, window_size_x, window_size_y)
+
+			# Create annotation of the training data in one image and count its labels
+			feature_mask_trimmed = feature_mask[direc_counter, :, window_size_x:-window_size_x, window_size_y:-window_size_y]
+			feature_label = np.zeros(feature_mask_trimmed.shape[1:])
+			for feature in xrange(feature_mask_trimmed.shape[0]):
+				feature_label += feature * feature_mask_trimmed[feature, :, :]
+			for label, count in zip(*np.unique(feature_label, return_counts=True)):
+				label_counts[label] = label_counts.get(label, 0) + count
+
+		channels.flush()
+		feature_mask.flush()
+
+		# We need to find the training data set with the least number of edge pixels. We will then sample
+		# that number of pixels from each of the training data sets (if possible)
+		if sub_sample:
+			max_num_of_pixels = max(list_of_edge_pixel_numbers)
+		else:
+			max_num_of_pixels = np.Inf
+
+		print(channels.shape)
+		num_of_pixels = []
+		for direc_counter in xrange(num_direcs):
+			rows, cols, labels = sample_pixels(feature_mask[direc_counter], window_size_x, window_size_y,
+											max_num_of_pixels=max_num_of_pixels)
+			num_of_pixels += [save_sampled_pixels(store_direc, direc_counter, rows, cols, labels)]
+
+		feature_rows, feature_cols, feature_batch, _ = load_sampled_pixels(store_direc, num_of_pixels,
+								max_training_examples=max_training_examples)
+
+		# Randomize
 		non_rand_ind = np.arange(len(feature_rows), dtype='int')
-		rand_ind = np.random.choice(non_rand_ind, size=max_training_examples, replace=False)
+		rand_ind = np.random.choice(non_rand_ind, size=len(feature_rows), replace=False)
 
 		feature_rows = feature_rows[rand_ind]
 		feature_cols = feature_cols[rand_ind]
 		feature_batch = feature_batch[rand_ind]
+		index = [feature_batch, feature_rows, feature_cols]
+		index = np.stack(index, axis=0)
 
-	# Randomize
-	non_rand_ind = np.arange(len(feature_rows), dtype='int')
-	rand_ind = np.random.choice(non_rand_ind, size=len(feature_rows), replace=False)
-
-	feature_rows = feature_rows[rand_ind]
-	feature_cols = feature_cols[rand_ind]
-	feature_batch = feature_batch[rand_ind]
-	index = [feature_batch, feature_rows, feature_cols]
-	index = np.stack(index, axis=0)
+		print(index.shape)
+		# Compute weight for each class (same as the 'balanced' mode of compute_class_weight)
+		classes = np.array(sorted(label_counts.keys()))
+		counts = np.array([label_counts[label] for label in classes], dtype='float64')
+		class_weights = np.sum(counts) / (len(classes) * counts)
 
-	print(index.shape)
-	# Compute weight for each class
-	class_weights = class_weight.compute_class_weight('balanced', classes=np.unique(feature_label.flatten()), y=feature_label.flatten())
-
-	# Save training data in npz format
-	np.savez(file_name_save, class_weights=class_weights, channels=channels, batch=feature_batch,
-			pixels_x=feature_rows, pixels_y=feature_cols, y=feature_mask, win_x=window_size_x, win_y=window_size_y)
+		# Save training data as memory-mappable arrays
+		save_training_data(file_name_save, window_size_x, window_size_y, class_weights=class_weights, channels=channels,
+				batch=feature_batch, pixels_x=feature_rows, pixels_y=feature_cols, y=feature_mask)
+	finally:
+		shutil.rmtree(store_direc)
 
 	if display:
 		_, ax = plt.subplots(len(training_direcs), 2, squeeze=False)
@@ -356,16 +393,20 @@ def make_training_data_fully_conv(max_training_examples=1e7, window_size_x=30, w
 			ax[j, 0].axes.get_xaxis().set_visible(False)
 			ax[j, 0].axes.get_yaxis().set_visible(False)
 
-			ax[j, 1].imshow(feature_label[j, :, :], cmap=plt.cm.gray, interpolation='nearest')
+			feature_mask_trimmed = feature_mask[j, :, window_size_x:-window_size_x, window_size_y:-window_size_y]
+			feature_label = np.zeros(feature_mask_trimmed.shape[1:])
+			for feature in xrange(feature_mask_trimmed.shape[0]):
+				feature_label += feature * feature_mask_trimmed[feature, :, :]
+			ax[j, 1].imshow(feature_label, cmap=plt.cm.gray, interpolation='nearest')
 			ax[j, 1].axes.get_xaxis().set_visible(False)
 			ax[j, 1].axes.get_yaxis().set_visible(False)
 		plt.show()
 
 	if verbose:
 		print("Number of features: %s" % str(num_of_features))
-		print("Number of training data points: %s" % str(np.prod(feature_label.shape[1:])))
-		print("Training data image shape: %s" % str(channels.shape))
-		print("Annotation image shape: %s" % str(feature_mask_trimmed.shape))
+		print("Number of training data points: %s" % str((image_size_x - 2*window_size_x) * (image_size_y - 2*window_size_y)))
+		print("Training data image shape: %s" % str((num_direcs, num_channels, image_size_x, image_size_y)))
+		print("Annotation image shape: %s" % str((num_direcs, num_of_features + 1, image_size_x - 2*window_size_x, image_size_y - 2*window_size_y)))
 
 	return None
 
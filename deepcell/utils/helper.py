@@ -16,6 +16,10 @@ Import python packages
 
 import os
 import re
+import json
+import hashlib
+import mmap
+import multiprocessing
 import numpy as np
 
 import tifffile.tifffile as tiff
@@ -103,25 +107,50 @@ def rate_scheduler(lr=.001, decay=0.95):
 		return new_lr
 	return output_fn
 
-def process_image(channel_img, win_x, win_y, std=False, remove_zeros=False):
+def normalize_local(channel_img, win_x, win_y, local_std=False):
+	"""Subtract from each pixel the mean of its (2*win_x+1, 2*win_y+1) window.
+	The window mean is a separable box filter, O(1) per pixel, with the same
+	reflected boundaries as a dense convolution with a box kernel. The image
+	is modified in place and keeps its dtype.
+	# Arguments
+		local_std: also divide each pixel by the standard deviation of its window.
+	"""
+	size = (2*win_x + 1, 2*win_y + 1)
+	local_mean = ndimage.uniform_filter(channel_img, size=size, mode='reflect')
+	if local_std:
+		local_var = ndimage.uniform_filter(channel_img * channel_img, size=size, mode='reflect') - local_mean * local_mean
+	channel_img -= local_mean
+	if local_std:
+		channel_img /= np.sqrt(np.maximum(local_var, 0)) + 1e-7
+	return channel_img
+
+def process_image(channel_img, win_x, win_y, std=False, remove_zeros=False, local_std=False):
 	if std:
-		avg_kernel = np.ones((2*win_x + 1, 2*win_y + 1))
-		channel_img -= ndimage.convolve(channel_img, avg_kernel)/avg_kernel.size
+		channel_img = normalize_local(channel_img, win_x, win_y, local_std=local_std)
 		std = np.std(channel_img)
 		channel_img /= std
 		return channel_img
 
 	if remove_zeros:
 		channel_img /= 255
-		avg_kernel = np.ones((2*win_x + 1, 2*win_y + 1))
-		channel_img -= ndimage.convolve(channel_img, avg_kernel)/avg_kernel.size
-		return channel_img
+		return normalize_local(channel_img, win_x, win_y, local_std=local_std)
 
 	p50 = np.percentile(channel_img, 50)
 	channel_img /= p50
-	avg_kernel = np.ones((2*win_x + 1, 2*win_y + 1))
-	channel_img -= ndimage.convolve(channel_img, avg_kernel)/avg_kernel.size
-	return channel_img
+	return normalize_local(channel_img, win_x, win_y, local_std=local_std)
+
+def sliding_window_view(arr, win_x, win_y):
+	"""Strided view of all (2*win_x+1, 2*win_y+1) windows over the last two axes of arr.
+	No data is copied. The window centered on pixel (i, j) is at
+	[..., i - win_x, j - win_y, :, :] of the returned view.
+	# Returns
+		A read-only array of shape
+		arr.shape[:-2] + (size_x - 2*win_x, size_y - 2*win_y, 2*win_x + 1, 2*win_y + 1).
+	"""
+	window_shape = (2*win_x + 1, 2*win_y + 1)
+	shape = arr.shape[:-2] + (arr.shape[-2] - window_shape[0] + 1, arr.shape[-1] - window_shape[1] + 1) + window_shape
+	strides = arr.strides + arr.strides[-2:]
+	return np.lib.stride_tricks.as_strided(arr, shape=shape, strides=strides, writeable=False)
 
 def get_image(file_name):
 	if '.tif' in file_name:
@@ -170,6 +199,173 @@ def get_images_from_directory(data_location, channel_names):
 
 	return all_images
 
+class PreprocessingCache(object):
+	"""On-disk cache of normalized images.
+	Entries are keyed by the content hash of the raw image files and the
+	normalization parameters, stored as .npy files that are memory-mapped
+	on load, and evicted least recently used first once the cache grows
+	over max_bytes.
+	# Arguments
+		cache_dir: directory of the cache.
+		max_bytes: size cap of the cache in bytes, None for no cap.
+	"""
+	def __init__(self, cache_dir, max_bytes=None):
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+
+	def key(self, file_names, **params):
+		"""Hash the contents of file_names together with the parameters."""
+		sha = hashlib.sha1()
+		for file_name in file_names:
+			with open(file_name, 'rb') as f:
+				for chunk in iter(lambda: f.read(1 << 20), b''):
+					sha.update(chunk)
+		sha.update(json.dumps(sorted(params.items())).encode('utf-8'))
+		return sha.hexdigest()
+
+	def _path(self, key):
+		return os.path.join(self.cache_dir, key + '.npy')
+
+	def get(self, key):
+		"""Return the memory-mapped array stored under key, or None."""
+		path = self._path(key)
+		if not os.path.isfile(path):
+			return None
+		# The modification time records the last use
+		os.utime(path, None)
+		return np.load(path, mmap_mode='r')
+
+	def put(self, key, arr):
+		"""Store arr under key and evict the least recently used entries."""
+		path = self._path(key)
+		temp_path = path + '.tmp'
+		with open(temp_path, 'wb') as f:
+			np.save(f, arr)
+		os.rename(temp_path, path)
+		self.evict()
+
+	def evict(self):
+		if self.max_bytes is None:
+			return
+		entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.npy')]
+		entries = sorted(entries, key=os.path.getmtime)
+		total = sum(os.path.getsize(f) for f in entries)
+		for entry in entries:
+			if total <= self.max_bytes:
+				break
+			total -= os.path.getsize(entry)
+			os.remove(entry)
+
+def get_processed_images_from_directory(data_location, channel_names, win_x=30, win_y=30, std=False,
+							cache_dir=None, cache_size=None):
+	"""Load the images of a directory and normalize them with process_image.
+	With a cache_dir, the normalized images are looked up by content hash
+	and normalization parameters, so repeated runs skip decoding and
+	normalizing them.
+	# Arguments
+		cache_size: size cap of the cache in bytes.
+	# Returns
+		A list of float32 arrays of shape (1, n_channels, size_x, size_y).
+	"""
+	if cache_dir is None:
+		cache = None
+	else:
+		cache = PreprocessingCache(cache_dir, max_bytes=cache_size)
+
+	img_list_channels = [nikon_getfiles(data_location, channel) for channel in channel_names]
+
+	all_images = []
+	for stack_iteration in xrange(len(img_list_channels[0])):
+		file_names = [os.path.join(data_location, img_list[stack_iteration]) for img_list in img_list_channels]
+		if cache is not None:
+			key = cache.key(file_names, win_x=win_x, win_y=win_y, std=std)
+			image = cache.get(key)
+			if image is not None:
+				all_images += [image]
+				continue
+
+		channels = []
+		for file_name in file_names:
+			channels += [process_image(get_image(file_name), win_x, win_y, std)]
+		image = np.stack(channels, axis=0)[np.newaxis].astype('float32')
+
+		if cache is not None:
+			cache.put(key, image)
+		all_images += [image]
+
+	return all_images
+
+def save_training_data(direc, win_x, win_y, **arrays):
+	"""Save training data as a directory of .npy arrays plus a JSON manifest.
+	Arrays that are already memory-mapped from `direc` (e.g. created with
+	np.lib.format.open_memmap) are flushed in place instead of being rewritten.
+	# Arguments
+		direc: directory of the training data.
+		win_x, win_y: half sizes of the training window.
+		arrays: the arrays to save, keyed by name.
+	"""
+	if not os.path.isdir(direc):
+		os.makedirs(direc)
+
+	manifest = {"format": "npy", "version": 1, "win_x": int(win_x), "win_y": int(win_y), "arrays": {}}
+	for name, arr in arrays.items():
+		file_name = os.path.join(direc, name + ".npy")
+		if isinstance(arr, np.memmap) and arr.filename is not None and \
+				os.path.abspath(arr.filename) == os.path.abspath(file_name):
+			arr.flush()
+		else:
+			np.save(file_name, arr)
+		manifest["arrays"][name] = {"file": name + ".npy", "shape": list(arr.shape), "dtype": str(arr.dtype)}
+
+	with open(os.path.join(direc, "manifest.json"), "w") as manifest_file:
+		json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+
+def load_training_data(file_name, mmap_mode='r'):
+	"""Load training data saved with save_training_data or a legacy npz file.
+	The arrays of a training data directory are memory-mapped, so processes
+	reading the same data share the page cache instead of holding copies.
+	# Returns
+		A dict with the training arrays and the window sizes.
+	"""
+	if not os.path.isdir(file_name):
+		training_data = np.load(file_name)
+		return dict((key, training_data[key]) for key in training_data.keys())
+
+	with open(os.path.join(file_name, "manifest.json")) as manifest_file:
+		manifest = json.load(manifest_file)
+
+	training_data = {"win_x": manifest["win_x"], "win_y": manifest["win_y"]}
+	for name, entry in manifest["arrays"].items():
+		training_data[str(name)] = np.load(os.path.join(file_name, entry["file"]), mmap_mode=mmap_mode)
+	return training_data
+
+def convert_npz_to_training_data(npz_file, direc):
+	"""Convert a legacy npz training data file into a training data directory."""
+	training_data = np.load(npz_file)
+	arrays = dict((key, training_data[key]) for key in training_data.keys() if key not in ("win_x", "win_y"))
+	save_training_data(direc, training_data["win_x"], training_data["win_y"], **arrays)
+
+def to_shared_array(arr):
+	"""Copy a numpy array into shared memory, so that worker processes
+	read it without each holding a copy. Memory-mapped arrays are already
+	shared through the page cache and are returned as is.
+	"""
+	if arr is None:
+		return arr
+	base = arr
+	while base is not None:
+		if isinstance(base, (np.memmap, mmap.mmap)):
+			return arr
+		base = getattr(base, 'base', None)
+
+	arr = np.asarray(arr)
+	shared = np.frombuffer(multiprocessing.RawArray('b', max(arr.nbytes, 1)),
+						dtype=arr.dtype, count=arr.size).reshape(arr.shape)
+	shared[...] = arr
+	return shared
+
 def _to_tensor(x, dtype):
 	"""Convert the input `x` to a tensor of type `dtype`.
 	# Arguments
@@ -15,6 +15,11 @@ Import python packages
 """
 
 import os
+import atexit
+import tempfile
+import threading
+import traceback
+import multiprocessing
 import numpy as np
 
 from keras import backend as K
@@ -58,8 +63,8 @@ def data_generator(channels, batch, mode='sample', labels=None, pixel_x=None, pi
 
 def get_data(file_name, mode='sample'):
 	if mode == 'sample':
-		training_data = np.load(file_name)
-		channels = training_data["channels"]
+		training_data = load_training_data(file_name, mmap_mode='r')
+		channels = np.asarray(training_data["channels"], dtype=K.floatx())
 		batch = training_data["batch"]
 		labels = training_data["y"]
 		pixels_x = training_data["pixels_x"]
@@ -81,14 +86,14 @@ def get_data(file_name, mode='sample'):
 		train_ind = arr_shuff[0:num_train]
 		test_ind = arr_shuff[num_train:num_train+num_test]
 
-		X_test, y_test = data_generator(channels.astype(K.floatx()), batch[test_ind], pixel_x=pixels_x[test_ind],
+		X_test, y_test = data_generator(channels, batch[test_ind], pixel_x=pixels_x[test_ind],
 								pixel_y=pixels_y[test_ind], labels=labels[test_ind], win_x=win_x, win_y=win_y)
-		train_dict = {"channels": channels.astype(K.floatx()), "batch": batch[train_ind], "pixels_x": pixels_x[train_ind], "pixels_y": pixels_y[train_ind], "labels": labels[train_ind], "win_x": win_x, "win_y": win_y}
+		train_dict = {"channels": channels, "batch": batch[train_ind], "pixels_x": pixels_x[train_ind], "pixels_y": pixels_y[train_ind], "labels": labels[train_ind], "win_x": win_x, "win_y": win_y}
 
 		return train_dict, (X_test, y_test)
 
 	else:
-		training_data = np.load(file_name)
+		training_data = load_training_data(file_name, mmap_mode='r')
 		channels = training_data["channels"]
 		labels = training_data["y"]
 		class_weights = training_data["class_weights"]
@@ -114,12 +119,12 @@ def get_data(file_name, mode='sample'):
 		train_ind = arr_shuff[0:num_train]
 		test_ind = arr_shuff[num_train:]
 
-		train_imgs, train_labels = data_generator(channels, train_ind, labels=labels, mode=mode)
+		# Only the test split is copied, the iterator reads training images from the mapped arrays
 		test_imgs, test_labels = data_generator(channels, test_ind, labels=labels, mode=mode)
 
 		if mode == 'conv':
 			# test_labels = np.moveaxis(test_labels, 1, 3)
-			train_dict = {"batch": batch, "pixels_x": pixels_x, "pixels_y": pixels_y, "channels": train_imgs, "labels": train_labels, "class_weights": class_weights, "win_x": win_x, "win_y": win_y}
+			train_dict = {"batch": batch, "pixels_x": pixels_x, "pixels_y": pixels_y, "channels": channels, "labels": labels, "train_ind": train_ind, "class_weights": class_weights, "win_x": win_x, "win_y": win_y}
 
 		return train_dict, (test_imgs, test_labels)
 
@@ -131,11 +136,319 @@ def transform_matrix_offset_center(matrix, x, y):
 	transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
 	return transform_matrix
 
+def random_flip_rotate_batch(x, row_axis, col_axis, horizontal_flip=False, vertical_flip=False, rotate_90=False, y=None):
+	"""Randomly flip and rotate by multiples of 90 degrees each image of a batch.
+	The transformations are drawn per image and applied with whole-batch array ops.
+	# Arguments
+		x: batch of images.
+		row_axis, col_axis: axes of the rows and columns in the batch.
+		horizontal_flip, vertical_flip: whether to randomly flip images.
+		rotate_90: whether to randomly rotate images by 0, 90, 180 or 270 degrees
+			(only 0 or 180 degrees for non-square images).
+		y: optional batch of label images transformed along with x.
+	# Returns
+		The transformed batch, and the transformed labels if y is given.
+	"""
+	n = x.shape[0]
+
+	if horizontal_flip:
+		flip = np.random.random(n) < 0.5
+		x[flip] = flip_axis(x[flip], col_axis)
+		if y is not None:
+			y[flip] = flip_axis(y[flip], col_axis)
+
+	if vertical_flip:
+		flip = np.random.random(n) < 0.5
+		x[flip] = flip_axis(x[flip], row_axis)
+		if y is not None:
+			y[flip] = flip_axis(y[flip], row_axis)
+
+	if rotate_90:
+		if x.shape[row_axis] == x.shape[col_axis]:
+			k = np.random.randint(4, size=n)
+		else:
+			k = 2 * np.random.randint(2, size=n)
+		for r in xrange(1, 4):
+			rotate = k == r
+			if np.any(rotate):
+				x[rotate] = np.rot90(x[rotate], r, axes=(row_axis, col_axis))
+				if y is not None:
+					y[rotate] = np.rot90(y[rotate], r, axes=(row_axis, col_axis))
+
+	if y is None:
+		return x
+	return x, y
+
+def random_transform_matrices(n, rows, cols, rotation_range=0., height_shift_range=0., width_shift_range=0.,
+		shear_range=0., zoom_range=(1, 1)):
+	"""Draw random affine transforms for a batch of images at once.
+	The transforms are composed as in random_transform and centered on the images.
+	# Arguments
+		n: number of images in the batch.
+		rows, cols: size of the images.
+	# Returns
+		The transform matrices, shape (n, 3, 3), and a boolean mask of the
+		images whose transform is the identity.
+	"""
+	zeros = np.zeros(n)
+	theta = np.pi / 180 * np.random.uniform(-rotation_range, rotation_range, n) if rotation_range else zeros
+	tx = np.random.uniform(-height_shift_range, height_shift_range, n) * rows if height_shift_range else zeros
+	ty = np.random.uniform(-width_shift_range, width_shift_range, n) * cols if width_shift_range else zeros
+	shear = np.random.uniform(-shear_range, shear_range, n) if shear_range else zeros
+	if zoom_range[0] == 1 and zoom_range[1] == 1:
+		zx, zy = np.ones(n), np.ones(n)
+	else:
+		zx, zy = np.random.uniform(zoom_range[0], zoom_range[1], (2, n))
+
+	# rotation * shift * shear * zoom, written out for the whole batch
+	cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+	cos_shear, sin_shear = np.cos(shear), -np.sin(shear)
+	transform_matrices = np.zeros((n, 3, 3))
+	transform_matrices[:, 0, 0] = cos_theta * zx
+	transform_matrices[:, 0, 1] = (cos_theta * sin_shear - sin_theta * cos_shear) * zy
+	transform_matrices[:, 0, 2] = cos_theta * tx - sin_theta * ty
+	transform_matrices[:, 1, 0] = sin_theta * zx
+	transform_matrices[:, 1, 1] = (sin_theta * sin_shear + cos_theta * cos_shear) * zy
+	transform_matrices[:, 1, 2] = sin_theta * tx + cos_theta * ty
+	transform_matrices[:, 2, 2] = 1
+
+	identity = (theta == 0) & (tx == 0) & (ty == 0) & (shear == 0) & (zx == 1) & (zy == 1)
+
+	o_x = float(rows) / 2 + 0.5
+	o_y = float(cols) / 2 + 0.5
+	offset_matrix = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
+	reset_matrix = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+	transform_matrices = np.matmul(np.matmul(offset_matrix, transform_matrices), reset_matrix)
+	return transform_matrices, identity
+
+def apply_transform_batch(x, transform_matrices, fill_mode='nearest', cval=0.):
+	"""Apply one affine transform per image to a channels first batch.
+	The sampling coordinates of the whole batch are computed in one step and
+	the batch is resampled (nearest neighbor, like apply_transform) with a
+	single gather.
+	# Arguments
+		x: 4D numpy array, batch of images (batch, channels, rows, cols).
+		transform_matrices: Numpy array of shape (batch, 3, 3).
+		fill_mode: Points outside the boundaries of the input
+			are filled according to the given mode
+			(one of `{'constant', 'nearest', 'reflect', 'wrap'}`).
+		cval: Value used for points outside the boundaries
+			of the input if `mode='constant'`.
+	# Returns
+		The transformed batch.
+	"""
+	n, n_channels, rows, cols = x.shape
+	grid_rows, grid_cols = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+	grid = np.stack([grid_rows.ravel(), grid_cols.ravel(), np.ones(rows*cols)], axis=0)
+	coords = np.matmul(transform_matrices[:, :2, :], grid)
+
+	if fill_mode not in ('nearest', 'constant'):
+		# Coordinates along the batch and channel axes are the identity
+		full_coords = np.empty((4, n, n_channels, rows*cols))
+		full_coords[0] = np.arange(n).reshape(n, 1, 1)
+		full_coords[1] = np.arange(n_channels).reshape(1, n_channels, 1)
+		full_coords[2] = coords[:, np.newaxis, 0, :]
+		full_coords[3] = coords[:, np.newaxis, 1, :]
+		x = ndimage.map_coordinates(x, full_coords.reshape(4, -1), order=0, mode=fill_mode, cval=cval)
+		return x.reshape(n, n_channels, rows, cols)
+
+	# Nearest neighbor resampling with the rounding and boundary rules of map_coordinates
+	coords_x, coords_y = coords[:, 0, :], coords[:, 1, :]
+	if fill_mode == 'constant':
+		outside = (coords_x < 0) | (coords_x > rows - 1) | (coords_y < 0) | (coords_y > cols - 1)
+	coords_x = np.floor(np.clip(coords_x, 0, rows - 1) + 0.5).astype('intp')
+	coords_y = np.floor(np.clip(coords_y, 0, cols - 1) + 0.5).astype('intp')
+	image_offsets = rows * cols * np.arange(n * n_channels).reshape(n, n_channels, 1)
+	flat_index = (coords_x * cols + coords_y)[:, np.newaxis, :] + image_offsets
+
+	x = np.ravel(x).take(flat_index)
+	if fill_mode == 'constant':
+		x = np.where(outside[:, np.newaxis, :], np.asarray(cval, dtype=x.dtype), x)
+	return x.reshape(n, n_channels, rows, cols)
+
+def random_channel_shift_batch(x, intensity):
+	"""Randomly shift the channels of each image of a channels first batch."""
+	n, n_channels = x.shape[:2]
+	min_x = np.min(x.reshape(n, -1), axis=1).reshape(n, 1, 1, 1)
+	max_x = np.max(x.reshape(n, -1), axis=1).reshape(n, 1, 1, 1)
+	shift = np.random.uniform(-intensity, intensity, (n, n_channels, 1, 1))
+	return np.clip(x + shift, min_x, max_x).astype(x.dtype)
+
+def random_transform_batch(x, image_data_generator, labels=None, rotate_90=False):
+	"""Randomly augment a channels first batch with the settings of image_data_generator.
+	The transform parameters of the whole batch are drawn at once. Images that
+	get an identity affine transform are not resampled, and flips and 90 degree
+	rotations are exact whole-batch array ops.
+	# Arguments
+		x: 4D numpy array, batch of images.
+		image_data_generator: generator holding the augmentation settings.
+		labels: optional batch of label images transformed along with x.
+		rotate_90: whether to randomly rotate images by multiples of 90 degrees.
+	# Returns
+		The transformed batch, and the transformed labels if labels are given.
+	"""
+	gen = image_data_generator
+	n, _, rows, cols = x.shape
+
+	transform_matrices, identity = random_transform_matrices(n, rows, cols,
+			rotation_range=gen.rotation_range, height_shift_range=gen.height_shift_range,
+			width_shift_range=gen.width_shift_range, shear_range=gen.shear_range, zoom_range=gen.zoom_range)
+
+	transform = np.logical_not(identity)
+	if np.any(transform):
+		x[transform] = apply_transform_batch(x[transform], transform_matrices[transform],
+										fill_mode=gen.fill_mode, cval=gen.cval)
+		if labels is not None:
+			# Label images are filled with the index of their maximum, as in random_transform
+			y = labels[transform]
+			y_cval = np.argmax(y.reshape(y.shape[0], -1), axis=1).reshape(-1, 1, 1, 1)
+			y = apply_transform_batch(y.astype('float64'), transform_matrices[transform],
+										fill_mode='constant', cval=np.nan)
+			labels[transform] = np.where(np.isnan(y), y_cval, y)
+
+	if gen.channel_shift_range != 0:
+		x = random_channel_shift_batch(x, gen.channel_shift_range)
+
+	if labels is None:
+		return random_flip_rotate_batch(x, 2, 3, horizontal_flip=gen.horizontal_flip,
+										vertical_flip=gen.vertical_flip, rotate_90=rotate_90)
+
+	x, labels = random_flip_rotate_batch(x, 2, 3, horizontal_flip=gen.horizontal_flip,
+										vertical_flip=gen.vertical_flip, rotate_90=rotate_90, y=labels)
+	return x, labels.astype('int')
+
+def standardize_batch(x, image_data_generator):
+	"""Apply the normalization configuration of image_data_generator to a batch.
+	The batch is returned untouched when no normalization is configured.
+	"""
+	gen = image_data_generator
+	if not (gen.preprocessing_function or gen.rescale or gen.samplewise_center
+			or gen.samplewise_std_normalization or gen.featurewise_center
+			or gen.featurewise_std_normalization or getattr(gen, 'zca_whitening', False)):
+		return x
+
+	for i in xrange(x.shape[0]):
+		x[i] = gen.standardize(x[i])
+	return x
+
+def _multiprocess_worker(iterator, seed, task_queue, result_queue):
+	# Each worker draws its augmentations from its own random stream
+	np.random.seed(seed)
+	while True:
+		index_array = task_queue.get()
+		if index_array is None:
+			break
+		try:
+			result_queue.put((True, iterator._get_batches_of_transformed_samples(index_array)))
+		except Exception:
+			result_queue.put((False, traceback.format_exc()))
+
+class MultiprocessIterator(object):
+	"""Build the batches of an iterator in a pool of worker processes.
+	The source arrays of the iterator are moved to shared memory, each worker
+	gets its own seeded random stream and at most `prefetch` batches are
+	built ahead of the training loop. The order of the batches, not the
+	sequence of indices, may differ from the single process iterator.
+	# Arguments
+		iterator: an iterator with `share_memory` and `next_index` methods,
+			as returned by `sample_flow` or `flow`.
+		workers: number of worker processes.
+		prefetch: maximum number of batches queued ahead, defaults to
+			twice the number of workers.
+		seed: seed of the worker random streams.
+	"""
+	def __init__(self, iterator, workers=1, prefetch=None, seed=None):
+		if workers < 1:
+			raise ValueError('`workers` should be at least 1. Received: ', workers)
+		self.iterator = iterator
+		self.workers = workers
+		self.prefetch = max(prefetch or 2 * workers, 1)
+		self.seed = seed
+		self.lock = threading.Lock()
+		self._processes = []
+		self._pending = 0
+
+	def _start(self):
+		self.iterator.share_memory()
+		self.task_queue = multiprocessing.Queue()
+		self.result_queue = multiprocessing.Queue(self.prefetch)
+		if self.seed is None:
+			seeds = np.random.randint(2**31 - 1, size=self.workers)
+		else:
+			seeds = self.seed + np.arange(self.workers)
+
+		for worker_seed in seeds:
+			process = multiprocessing.Process(target=_multiprocess_worker,
+				args=(self.iterator, int(worker_seed), self.task_queue, self.result_queue))
+			process.daemon = True
+			process.start()
+			self._processes.append(process)
+		atexit.register(self.close)
+
+	def close(self):
+		"""Stop the worker processes."""
+		if not self._processes:
+			return
+		for _ in self._processes:
+			self.task_queue.put(None)
+		# Drain the queued batches so that the workers can exit
+		while self._pending > 0:
+			self.result_queue.get()
+			self._pending -= 1
+		for process in self._processes:
+			process.join(1)
+			if process.is_alive():
+				process.terminate()
+		self._processes = []
+
+	def __iter__(self):
+		return self
+
+	def __next__(self, *args, **kwargs):
+		return self.next(*args, **kwargs)
+
+	def next(self):
+		"""For python 2.x.
+		# Returns the next batch.
+		"""
+		with self.lock:
+			if not self._processes:
+				self._start()
+			while self._pending < self.prefetch:
+				self.task_queue.put(self.iterator.next_index())
+				self._pending += 1
+			success, batch = self.result_queue.get()
+			self._pending -= 1
+
+		if not success:
+			raise RuntimeError('A data loading worker failed:\n' + batch)
+		return batch
+
 class ImageSampleArrayIterator(Iterator):
+	"""Iterator over windows sampled around training pixels.
+	Augmented windows can be served from an on-disk cache holding
+	`cache_variants` augmented copies of every window. Each batch picks
+	one of the cached variants of its windows at random, and every
+	`cache_refresh` epochs the oldest variant is replaced. The new
+	variant is generated into a spare slot that batches never read, a
+	chunk per batch over the first half of the epoch, and only takes the
+	place of the oldest one once it is complete. The evicted slot becomes
+	the spare and is not rewritten before the next refresh.
+	# Arguments
+		cache_dir: directory of the augmentation cache, None to augment
+			every batch on the fly.
+		cache_variants: number of augmented variants of each window.
+		cache_size: size budget of the cache in bytes, including the spare
+			slot, the number of variants is reduced to fit in it.
+		cache_dtype: dtype of the cached windows.
+		cache_refresh: number of epochs between two regenerations, None
+			to keep the cache for the whole training.
+	"""
 	def __init__(self, train_dict, image_data_generator,
 				 batch_size=32, shuffle=False, seed=None,
 				 data_format=None,
-				 save_to_dir=None, save_prefix='', save_format='png'):
+				 save_to_dir=None, save_prefix='', save_format='png',
+				 cache_dir=None, cache_variants=4, cache_size=None, cache_dtype='float16', cache_refresh=None):
 
 		if train_dict["labels"] is not None and len(train_dict["pixels_x"]) != len(train_dict["labels"]):
 			raise Exception('Number of sampled pixels and y (labels) '
@@ -155,8 +468,11 @@ class ImageSampleArrayIterator(Iterator):
 		self.b = train_dict["batch"]
 		self.pixels_x = train_dict["pixels_x"]
 		self.pixels_y = train_dict["pixels_y"]
-		self.win_x = train_dict["win_x"]
-		self.win_y = train_dict["win_y"]
+		self.win_x = int(train_dict["win_x"])
+		self.win_y = int(train_dict["win_y"])
+		# Strided view of every window of the training images, so that
+		# a whole batch is gathered with a single fancy-indexing op
+		self.windows = sliding_window_view(self.x, self.win_x, self.win_y)
 		self.image_data_generator = image_data_generator
 		self.data_format = data_format
 		self.save_to_dir = save_to_dir
@@ -164,28 +480,109 @@ class ImageSampleArrayIterator(Iterator):
 		self.save_format = save_format
 		super(ImageSampleArrayIterator, self).__init__(len(train_dict["labels"]), batch_size, shuffle, seed)
 
+		self.cache = None
+		if cache_dir is not None:
+			self._make_cache(cache_dir, cache_variants, cache_size, cache_dtype, cache_refresh)
+
+	def _make_cache(self, cache_dir, cache_variants, cache_size, cache_dtype, cache_refresh):
+		window_shape = (self.x.shape[1], 2*self.win_x + 1, 2*self.win_y + 1)
+		variant_size = self.n * int(np.prod(window_shape)) * np.dtype(cache_dtype).itemsize
+		n_spare = 1 if cache_refresh else 0
+		n_variants = cache_variants
+		if cache_size is not None:
+			n_variants = min(n_variants, int(cache_size // variant_size) - n_spare)
+		if n_variants < 1:
+			raise ValueError('The augmentation cache needs at least %s bytes '
+							'for %s variants of every window. Received cache_size = %s' % ((1 + n_spare) * variant_size, 1 + n_spare, cache_size))
+
+		fd, cache_file = tempfile.mkstemp(prefix='augmented_windows_', suffix='.npy', dir=cache_dir)
+		os.close(fd)
+		atexit.register(os.remove, cache_file)
+		self.cache = np.lib.format.open_memmap(cache_file, mode='w+', dtype=cache_dtype,
+											shape=(n_variants + n_spare, self.n) + window_shape)
+		self.cache_refresh = cache_refresh
+		self._cache_epoch = 0
+		self._cache_oldest = 0
+
+		# Slots that batches read from, the last slot is the spare
+		self._cache_slots = np.arange(n_variants)
+		self._cache_spare = n_variants
+		self._refresh_start = None
+		steps_per_epoch = int(np.ceil(self.n / float(self.batch_size)))
+		self._refresh_chunk = int(np.ceil(self.n / float(max(steps_per_epoch // 2, 1))))
+
+		for variant in xrange(n_variants):
+			self._fill_cache(variant)
+
+	def _fill_cache(self, slot, start=0, stop=None, chunk_size=4096):
+		if stop is None:
+			stop = self.n
+		for chunk_start in xrange(start, stop, chunk_size):
+			index_array = np.arange(chunk_start, min(chunk_start + chunk_size, stop))
+			batch_x = self.windows[self.b[index_array], :,
+								self.pixels_x[index_array] - self.win_x, self.pixels_y[index_array] - self.win_y]
+			self.cache[slot, index_array[0]:index_array[-1] + 1] = self.image_data_generator.random_transform_batch(batch_x)
+
+	def _refresh_cache_chunk(self):
+		stop = min(self._refresh_start + self._refresh_chunk, self.n)
+		self._fill_cache(self._cache_spare, self._refresh_start, stop)
+		self._refresh_start = stop
+		if stop < self.n:
+			return
+
+		# The new variant is complete, swap it with the oldest one
+		self.cache.flush()
+		retired = self._cache_slots[self._cache_oldest]
+		self._cache_slots[self._cache_oldest] = self._cache_spare
+		self._cache_spare = retired
+		self._cache_oldest = (self._cache_oldest + 1) % len(self._cache_slots)
+		self._refresh_start = None
+
+	def next_index(self):
+		"""Draw the indices of the next batch. In the epochs where the
+		augmentation cache is due for a refresh, also regenerate a chunk
+		of the spare variant.
+		"""
+		with self.lock:
+			index_array = next(self.index_generator)
+			if self.cache is not None and self.cache_refresh:
+				if index_array[1] == 0:
+					self._cache_epoch += 1
+					if self._cache_epoch > 1 and (self._cache_epoch - 1) % self.cache_refresh == 0:
+						self._refresh_start = 0
+				if self._refresh_start is not None:
+					self._refresh_cache_chunk()
+		return index_array
+
+	def share_memory(self):
+		"""Move the training arrays to shared memory, for MultiprocessIterator."""
+		self.x = to_shared_array(self.x)
+		self.windows = sliding_window_view(self.x, self.win_x, self.win_y)
+		self.y = to_shared_array(self.y)
+		self.b = to_shared_array(self.b)
+		self.pixels_x = to_shared_array(self.pixels_x)
+		self.pixels_y = to_shared_array(self.pixels_y)
+		if self.cache is not None:
+			# Workers see the slots swapped in by the refreshes of the parent
+			self._cache_slots = to_shared_array(self._cache_slots)
+
 	def _get_batches_of_transformed_samples(self, index_array):
 		index_array = index_array[0]
-		if self.channels_axis == 1:
-			batch_x = np.zeros(tuple([len(index_array)] + [self.x.shape[1]] + [2*self.win_x + 1, 2*self.win_y + 1]))
+		batch = self.b[index_array]
+		pixels_x = self.pixels_x[index_array]
+		pixels_y = self.pixels_y[index_array]
+
+		# Windows are gathered channels first, with shape (batch, channels, 2*win_x+1, 2*win_y+1)
+		if self.cache is not None:
+			variants = self._cache_slots[np.random.randint(len(self._cache_slots), size=len(index_array))]
+			batch_x = np.asarray(self.cache[variants, index_array], dtype=K.floatx())
 		else:
-			batch_x = np.zeros(tuple([len(index_array)] + [2*self.win_x + 1, 2*self.win_y + 1] + [self.x.shape[1]]))
+			batch_x = self.windows[batch, :, pixels_x - self.win_x, pixels_y - self.win_y]
+			batch_x = self.image_data_generator.random_transform_batch(batch_x)
+		batch_x = self.image_data_generator.standardize_batch(batch_x)
 
-		for i, j in enumerate(index_array):
-			batch = self.b[j]
-			pixel_x = self.pixels_x[j]
-			pixel_y = self.pixels_y[j]
-			win_x = self.win_x
-			win_y = self.win_y
-
-			x = self.x[batch, :, pixel_x-win_x:pixel_x+win_x+1, pixel_y-win_y:pixel_y+win_y+1]
-			x = self.image_data_generator.random_transform(x.astype(K.floatx()))
-			x = self.image_data_generator.standardize(x)
-
-			if self.channels_axis == 1:
-				batch_x[i] = x
-			if self.channels_axis == 3:
-				batch_x[i] = np.moveaxis(x, 1, 3)
+		if self.channels_axis == 3:
+			batch_x = np.moveaxis(batch_x, 1, 3)
 
 		if self.save_to_dir:
 			for i, j in enumerate(index_array):
@@ -207,20 +604,50 @@ class ImageSampleArrayIterator(Iterator):
 
 		# Keeps under lock only the mechanism which advances
 		# the indexing of each batch.
-		with self.lock:
-			index_array = next(self.index_generator)
-			# The transformation of images is not under thread lock
-			# so it can be done in parallel
+		index_array = self.next_index()
+		# The transformation of images is not under thread lock
+		# so it can be done in parallel
 		return self._get_batches_of_transformed_samples(index_array)
 
 class SampleDataGenerator(ImageDataGenerator):
+	"""ImageDataGenerator for windows sampled around training pixels.
+	# Arguments
+		rotate_90: whether to randomly rotate windows by multiples of 90 degrees.
+		kwargs: the arguments of ImageDataGenerator.
+	"""
+	def __init__(self, rotate_90=False, **kwargs):
+		super(SampleDataGenerator, self).__init__(**kwargs)
+		self.rotate_90 = rotate_90
+
+	def random_transform_batch(self, x, seed=None):
+		"""Randomly augment a batch of channels first windows.
+		# Arguments
+			x: 4D tensor, batch of windows.
+			seed: random seed.
+		# Returns
+			The randomly transformed batch.
+		"""
+		if seed is not None:
+			np.random.seed(seed)
+		return random_transform_batch(x, self, rotate_90=self.rotate_90)
+
+	def standardize_batch(self, x):
+		"""Apply the normalization configuration to a batch of windows."""
+		return standardize_batch(x, self)
+
 	def sample_flow(self, train_dict, batch_size=32, shuffle=True, seed=None,
-			 save_to_dir=None, save_prefix='', save_format='png'):
-		return ImageSampleArrayIterator(
+			 save_to_dir=None, save_prefix='', save_format='png', workers=0, prefetch=None,
+			 cache_dir=None, cache_variants=4, cache_size=None, cache_dtype='float16', cache_refresh=None):
+		iterator = ImageSampleArrayIterator(
 			train_dict, self,
 			batch_size=batch_size, shuffle=shuffle, seed=seed,
 			data_format=self.data_format,
-			save_to_dir=save_to_dir, save_prefix=save_prefix, save_format=save_format)
+			save_to_dir=save_to_dir, save_prefix=save_prefix, save_format=save_format,
+			cache_dir=cache_dir, cache_variants=cache_variants, cache_size=cache_size,
+			cache_dtype=cache_dtype, cache_refresh=cache_refresh)
+		if workers > 0:
+			return MultiprocessIterator(iterator, workers=workers, prefetch=prefetch, seed=seed)
+		return iterator
 
 class ImageFullyConvIterator(Iterator):
 	def __init__(self, train_dict, image_data_generator,
@@ -228,7 +655,8 @@ class ImageFullyConvIterator(Iterator):
 				 data_format=None,
 				 save_to_dir=None, save_prefix='', save_format='png'):
 		print(train_dict.keys())
-		self.x = np.asarray(train_dict["channels"], dtype=K.floatx())
+		# Images stay memory-mapped, only the images of a batch are read and cast
+		self.x = train_dict["channels"]
 		self.win_x = train_dict["win_x"]
 		self.win_y = train_dict["win_y"]
 		self.batch_index = train_dict["batch"]
@@ -252,46 +680,43 @@ class ImageFullyConvIterator(Iterator):
 		channels_axis = 3 if data_format == 'channels_last' else 1
 		self.channels_axis = channels_axis
 		self.y = train_dict["labels"]
+		self.train_ind = train_dict.get("train_ind")
+		if self.train_ind is None:
+			self.train_ind = np.arange(self.x.shape[0])
 
 		self.image_data_generator = image_data_generator
 		self.data_format = data_format
 		self.save_to_dir = save_to_dir
 		self.save_prefix = save_prefix
 		self.save_format = save_format
-		super(ImageFullyConvIterator, self).__init__(self.x.shape[0], batch_size, shuffle, seed)
+		super(ImageFullyConvIterator, self).__init__(len(self.train_ind), batch_size, shuffle, seed)
 
-	def _get_batches_of_transformed_samples(self, index_array):
-		index_array = index_array[0]
-		if self.channels_axis == 1:
-			batch_x = np.zeros(tuple([len(index_array)] + [self.x.shape[1], self.x.shape[2], self.x.shape[3]]))
-			if self.y is not None:
-				batch_y = np.zeros(tuple([len(index_array)] + [self.y.shape[1], self.y.shape[2], self.y.shape[3]]))
-		else:
-			batch_x = np.zeros(tuple([len(index_array)] + [self.x.shape[2], self.x.shape[3]] + [self.x.shape[1]]))
-			if self.y is not None:
-				batch_y = np.zeros(tuple([len(index_array)] + [self.y.shape[2], self.y.shape[3]] + self.y.shape[1]))
+	def share_memory(self):
+		"""Move the training arrays to shared memory, for MultiprocessIterator."""
+		self.x = to_shared_array(self.x)
+		self.y = to_shared_array(self.y)
 
-		for i, j in enumerate(index_array):
-			batch = j
+	def next_index(self):
+		"""Draw the indices of the next batch."""
+		with self.lock:
+			return next(self.index_generator)
 
-			x = self.x[batch, :, :, :]
+	def _get_batches_of_transformed_samples(self, index_array):
+		index_array = self.train_ind[index_array[0]]
+
+		# The whole batch is transformed at once, channels first
+		batch_x = np.asarray(self.x[index_array], dtype=K.floatx())
+		if self.y is not None:
+			batch_y = np.array(self.y[index_array], dtype=K.floatx())
+			batch_x, batch_y = self.image_data_generator.random_transform_batch(batch_x, batch_y)
+			batch_y = batch_y.astype(K.floatx())
+		else:
+			batch_x = self.image_data_generator.random_transform_batch(batch_x)
 
-			if self.y is not None:
-				y = self.y[batch, :, :, :]
+		batch_x = self.image_data_generator.standardize_batch(batch_x)
 
-			if self.y is not None:
-				x, y = self.image_data_generator.random_transform(x.astype(K.floatx()), y)
-			else:
-				x = self.image_data_generator.random_transform(x.astype(K.floatx()))
-
-			x = self.image_data_generator.standardize(x)
-
-			if self.channels_axis == 1:
-				batch_x[i] = x
-				batch_y[i] = y
-			if self.channels_axis == 3:
-				batch_x[i] = np.moveaxis(x, 1, 3)
-				batch_y[i] = np.moveaxis(y, 1, 3)
+		if self.channels_axis == 3:
+			batch_x = np.moveaxis(batch_x, 1, 3)
 
 		if self.save_to_dir:
 			for i, j in enumerate(index_array):
@@ -532,12 +957,15 @@ class ImageFullyConvDataGenerator(object):
 							 'Received arg: ', zoom_range)
 
 	def flow(self, train_dict, batch_size=1, shuffle=True, seed=None,
-			save_to_dir=None, save_prefix='', save_format='png'):
-		return ImageFullyConvIterator(
+			save_to_dir=None, save_prefix='', save_format='png', workers=0, prefetch=None):
+		iterator = ImageFullyConvIterator(
 			train_dict, self,
 			batch_size=batch_size, shuffle=shuffle, seed=seed,
 			data_format=self.data_format,
 			save_to_dir=save_to_dir, save_prefix=save_prefix, save_format=save_format)
+		if workers > 0:
+			return MultiprocessIterator(iterator, workers=workers, prefetch=prefetch, seed=seed)
+		return iterator
 
 	def standardize(self, x):
 		"""Apply the normalization configuration to a batch of inputs.
@@ -576,6 +1004,23 @@ class ImageFullyConvDataGenerator(object):
 
 		return x
 
+	def random_transform_batch(self, x, labels=None, seed=None):
+		"""Randomly augment a channels first batch of images and their labels.
+		# Arguments
+			x: 4D tensor, batch of images.
+			labels: optional 4D tensor, batch of label images.
+			seed: random seed.
+		# Returns
+			The randomly transformed batch (and labels).
+		"""
+		if seed is not None:
+			np.random.seed(seed)
+		return random_transform_batch(x, self, labels=labels)
+
+	def standardize_batch(self, x):
+		"""Apply the normalization configuration to a batch of images."""
+		return standardize_batch(x, self)
+
 	def random_transform(self, x, labels=None, seed=None):
 		"""Randomly augment a single image tensor.
 		# Arguments
@@ -5,6 +5,54 @@ from skimage import morphology as morph
 from skimage.measure import label, regionprops
 import numpy as np
 
+def overlap_table(label_a, label_b):
+	"""Sparse overlap matrix of two label images, built in one pass.
+	Returns the (label_a, label_b, overlap) triplets of every pair of
+	objects that share pixels, sorted by label_a then label_b, and the
+	areas of the objects of both images indexed by label.
+	"""
+	label_a = np.asarray(label_a, dtype=np.int64).ravel()
+	label_b = np.asarray(label_b, dtype=np.int64).ravel()
+	n_b = np.amax(label_b) + 1
+
+	area_a = np.bincount(label_a)
+	area_b = np.bincount(label_b)
+
+	both = (label_a > 0) & (label_b > 0)
+	pairs, overlaps = np.unique(label_a[both] * n_b + label_b[both], return_counts=True)
+	return pairs // n_b, pairs % n_b, overlaps, area_a, area_b
+
+def match_objects(val_label, mask_label):
+	"""Match every validation object to the predicted object it overlaps most.
+	Ties go to the lowest predicted label.
+	# Returns
+		A dict of per validation object arrays (index i is label i+1):
+		"match" (predicted label, 0 if none), "overlap", "jaccard" and
+		"dice" (nan for objects without overlap).
+	"""
+	val_ids, mask_ids, overlaps, val_area, mask_area = overlap_table(val_label, mask_label)
+	n_val = len(val_area) - 1
+
+	# Largest overlap first, then lowest predicted label, within each validation object
+	order = np.lexsort((mask_ids, -overlaps, val_ids))
+	val_ids, mask_ids, overlaps = val_ids[order], mask_ids[order], overlaps[order]
+	first = np.ones(len(val_ids), dtype='bool')
+	first[1:] = val_ids[1:] != val_ids[:-1]
+	val_ids, mask_ids, overlaps = val_ids[first], mask_ids[first], overlaps[first]
+
+	match = np.zeros(n_val, dtype=np.int64)
+	best_overlap = np.zeros(n_val, dtype=np.int64)
+	match[val_ids - 1] = mask_ids
+	best_overlap[val_ids - 1] = overlaps
+
+	jaccard = np.full(n_val, np.nan)
+	dice = np.full(n_val, np.nan)
+	area_sum = val_area[val_ids] + mask_area[mask_ids]
+	jaccard[val_ids - 1] = overlaps.astype('float64') / (area_sum - overlaps)
+	dice[val_ids - 1] = 2 * overlaps.astype('float64') / area_sum
+
+	return {"match": match, "overlap": best_overlap, "jaccard": jaccard, "dice": dice}
+
 def dice_jaccard_indices(mask, val, nuc_mask):
 
 	strel = morph.disk(1)
@@ -15,45 +63,16 @@ def dice_jaccard_indices(mask, val, nuc_mask):
 	mask_label = label(mask, background=0)
 	val_label = label(val, background=0)
 
-	for j in xrange(1, np.amax(val_label)+1):
-		if np.sum((val_label == j) * nuc_mask) == 0:
-			val_label[val_label == j] = 0
+	# Keep only the validation objects that touch a nucleus
+	nuclear_ids = np.unique(val_label[nuc_mask != 0])
+	val_label[np.logical_not(np.in1d(val_label, nuclear_ids).reshape(val_label.shape))] = 0
 
 	val_label = label(val_label > 0, background=0)
 
-	mask_region = regionprops(mask_label)
-	val_region = regionprops(val_label)
-
-	jac_list = []
-	dice_list = []
-
-	for val_prop in val_region:
-		temp = val_prop['coords'].tolist()
-		internal_points_1 = set([tuple(l) for l in temp])
-		best_mask_prop = mask_region[0]
-		best_overlap = 0
-		best_sum = 0
-		best_union = 0
-
-		for mask_prop in mask_region:
-			temp = mask_prop['coords'].tolist()
-			internal_points_2 = set([tuple(l) for l in temp])
-
-			overlap = internal_points_1 & internal_points_2
-			num_overlap = len(overlap)
-
-			if num_overlap > best_overlap:
-				best_mask_prop = mask_prop
-				best_overlap = num_overlap
-				best_union = len(internal_points_1 | internal_points_2)
-				best_sum = len(internal_points_1) + len(internal_points_2)
-
-		jac = np.float32(best_overlap)/np.float32(best_union)
-		dice = np.float32(best_overlap)*2/best_sum
-
-		if np.isnan(jac) == 0 and np.isnan(dice) == 0:
-			jac_list += [jac]
-			dice_list += [dice]
+	matches = match_objects(val_label, mask_label)
+	matched = np.logical_not(np.isnan(matches["jaccard"]))
+	jac_list = matches["jaccard"][matched].tolist()
+	dice_list = matches["dice"][matched].tolist()
 
 	JI = np.mean(jac_list)
 	DI = np.mean(dice_list)
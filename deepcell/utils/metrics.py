@@ -0,0 +1,144 @@
+"""
+Instance segmentation metrics computed from the overlap matrix of two label images
+"""
+import os
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
+from skimage.measure import label
+
+from .helper import get_image, nikon_getfiles
+from .indice import overlap_table
+
+def sparse_iou(true_ids, pred_ids, overlaps, true_area, pred_area):
+	"""Sparse IoU matrix built from an overlap_table, indexed by label (row and column 0 are empty)."""
+	iou = overlaps.astype('float64') / (true_area[true_ids] + pred_area[pred_ids] - overlaps)
+	shape = (len(true_area), len(pred_area))
+	return sparse.csr_matrix((iou, (true_ids, pred_ids)), shape=shape)
+
+def iou_matrix(label_true, label_pred):
+	"""Sparse IoU matrix of two label images, indexed by label (row and column 0 are empty)."""
+	true_ids, pred_ids, overlaps, true_area, pred_area = overlap_table(label_true, label_pred)
+	return sparse_iou(true_ids, pred_ids, overlaps, true_area, pred_area), true_area, pred_area
+
+def optimal_matching(iou):
+	"""Match true and predicted objects one to one, maximizing the total IoU.
+	The Hungarian algorithm runs on each connected component of the overlap
+	graph, so it only sees the few objects that actually overlap.
+	# Returns
+		The true labels, predicted labels and IoU of the matched pairs.
+	"""
+	n_true, n_pred = iou.shape
+	graph = sparse.bmat([[None, iou], [iou.T, None]], format='csr')
+	n_components, components = connected_components(graph, directed=False)
+	true_components = components[:n_true]
+
+	coo = iou.tocoo()
+	pair_components = true_components[coo.row]
+
+	# Components made of a single overlapping pair are matched directly
+	single = np.bincount(pair_components, minlength=n_components)[pair_components] == 1
+	matched_true, matched_pred, matched_iou = [coo.row[single]], [coo.col[single]], [coo.data[single]]
+
+	pairs_left = np.flatnonzero(np.logical_not(single))
+	order = pairs_left[np.argsort(pair_components[pairs_left], kind='mergesort')]
+	bounds = np.flatnonzero(np.diff(pair_components[order])) + 1
+
+	for pairs in np.split(order, bounds):
+		if len(pairs) == 0:
+			continue
+		rows, row_index = np.unique(coo.row[pairs], return_inverse=True)
+		cols, col_index = np.unique(coo.col[pairs], return_inverse=True)
+		cost = np.zeros((len(rows), len(cols)))
+		cost[row_index, col_index] = -coo.data[pairs]
+		assigned_rows, assigned_cols = linear_sum_assignment(cost)
+		assigned_iou = -cost[assigned_rows, assigned_cols]
+		keep = assigned_iou > 0
+		matched_true += [rows[assigned_rows[keep]]]
+		matched_pred += [cols[assigned_cols[keep]]]
+		matched_iou += [assigned_iou[keep]]
+
+	return np.concatenate(matched_true), np.concatenate(matched_pred), np.concatenate(matched_iou)
+
+def instance_metrics(label_true, label_pred, thresholds=np.arange(0.5, 1.0, 0.05), split_fraction=0.5):
+	"""Object level metrics of a predicted label image against the ground truth.
+	# Arguments
+		label_true, label_pred: label images, 0 is background.
+		thresholds: IoU thresholds at which matched pairs count as true positives.
+		split_fraction: fraction of a predicted object inside a true object
+			for it to count towards a split (and conversely for merges).
+	# Returns
+		A dict with the object counts, the true positive, false positive and
+		false negative counts and the average precision TP / (TP + FP + FN)
+		at each threshold, their mean, and the split and merge counts.
+	"""
+	true_ids, pred_ids, overlaps, true_area, pred_area = overlap_table(label_true, label_pred)
+	iou = sparse_iou(true_ids, pred_ids, overlaps, true_area, pred_area)
+	n_true = np.count_nonzero(true_area[1:])
+	n_pred = np.count_nonzero(pred_area[1:])
+
+	_, _, matched_iou = optimal_matching(iou)
+	thresholds = np.asarray(thresholds)
+	tp = np.sum(matched_iou[np.newaxis, :] >= thresholds[:, np.newaxis], axis=1)
+	fp = n_pred - tp
+	fn = n_true - tp
+	with np.errstate(divide='ignore', invalid='ignore'):
+		ap = tp.astype('float64') / (tp + fp + fn)
+
+	# A split is a true object covering most of several predicted objects, a merge the converse
+	pred_inside = overlaps >= split_fraction * pred_area[pred_ids]
+	true_inside = overlaps >= split_fraction * true_area[true_ids]
+	splits = np.count_nonzero(np.bincount(true_ids[pred_inside], minlength=len(true_area)) > 1)
+	merges = np.count_nonzero(np.bincount(pred_ids[true_inside], minlength=len(pred_area)) > 1)
+
+	return {"n_true": n_true,
+			"n_pred": n_pred,
+			"thresholds": thresholds,
+			"true_positives": tp,
+			"false_positives": fp,
+			"false_negatives": fn,
+			"average_precision": ap,
+			"mean_average_precision": np.mean(ap),
+			"splits": splits,
+			"merges": merges}
+
+def to_label_image(img):
+	"""Label image of a mask, images with more than two values are taken as label images already."""
+	if len(np.unique(img)) > 2:
+		return img.astype(np.int64)
+	return label(img > 0, background=0)
+
+def _evaluate_files(args):
+	true_file, pred_file, kwargs = args
+	label_true = to_label_image(get_image(true_file))
+	label_pred = to_label_image(get_image(pred_file))
+	return instance_metrics(label_true, label_pred, **kwargs)
+
+def evaluate_directory(direc_val, direc_pred, val_channel='interior', pred_channel='cytoplasm_mask',
+						processes=None, **kwargs):
+	"""Evaluate every predicted mask of a directory against its validation mask, in parallel.
+	Validation and predicted images are paired by their sorted order.
+	# Arguments
+		direc_val: the Validation directory.
+		direc_pred: directory of the predicted masks.
+		processes: number of worker processes, defaults to the number of cores.
+		kwargs: passed to instance_metrics.
+	# Returns
+		The list of the instance_metrics of every image.
+	"""
+	val_files = [os.path.join(direc_val, f) for f in nikon_getfiles(direc_val, val_channel)]
+	pred_files = [os.path.join(direc_pred, f) for f in nikon_getfiles(direc_pred, pred_channel)]
+	if len(val_files) != len(pred_files):
+		raise ValueError('Found %s validation images and %s predicted images' % (len(val_files), len(pred_files)))
+
+	tasks = [(val_file, pred_file, kwargs) for val_file, pred_file in zip(val_files, pred_files)]
+	pool = multiprocessing.Pool(processes)
+	try:
+		results = pool.map(_evaluate_files, tasks)
+	finally:
+		pool.close()
+		pool.join()
+	return results
@@ -10,12 +10,15 @@ Assortment of CNN architectures for single cell segmentation
 @author: David Van Valen
 """
 
+import time
+import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.keras import backend as K
 from keras.models import Sequential, Model
 from keras.layers import Conv2D, MaxPool2D, Activation, Lambda, Flatten, BatchNormalization, Permute, Input, Concatenate
 from keras.regularizers import l2
 from .cnn import dilated_MaxPool2D, TensorProd2D, axis_softmax
+from .helper import sliding_window_view
 
 """
 Batch normalized conv-nets
@@ -60,7 +63,7 @@ def dilated_bn_feature_net_21x21(input_shape=(2, 1080, 1280), n_features=3, n_ch
 	print("Using dilated feature net 21x21 with batch normalization")
 	model = Sequential()
 	d = 1
-	model.add(Conv2D(32, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', input_shape=(n_channels, 21, 21), kernel_regularizer=l2(reg)))
+	model.add(Conv2D(32, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', input_shape=input_shape, kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 
@@ -89,10 +92,9 @@ def dilated_bn_feature_net_21x21(input_shape=(2, 1080, 1280), n_features=3, n_ch
 	model.add(TensorProd2D(200, n_features, kernel_initializer=init, kernel_regularizer=l2(reg)))
 
 	if from_logits is True:
-		model.add(Permute((1, 3, 4, 2)))
+		model.add(Permute((2, 3, 1)))
 
 	if from_logits is False:
-		model.add(Flatten())
 		model.add(Activation(axis_softmax))
 
 	if weights_path is not None:
@@ -136,11 +138,11 @@ def bn_feature_net_31x31(n_features=3, n_channels=1, reg=1e-5, init='he_normal')
 
 	return model
 
-def dilated_bn_feature_net_31x31(n_features=3, n_channels=1, reg=1e-5, init='he_normal', from_logits=False, weights_path=None):
+def dilated_bn_feature_net_31x31(input_shape=(2, 1080, 1280), n_features=3, n_channels=1, reg=1e-5, init='he_normal', from_logits=False, weights_path=None):
 	print("Using dilated feature net 31x31 with batch normalization")
 	model = Sequential()
 	d = 1
-	model.add(Conv2D(32, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', input_shape=(n_channels, 31, 31), kernel_regularizer=l2(reg)))
+	model.add(Conv2D(32, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', input_shape=input_shape, kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 	model.add(dilated_MaxPool2D(dilation_rate=d, pool_size=(2, 2)))
@@ -171,7 +173,7 @@ def dilated_bn_feature_net_31x31(n_features=3, n_channels=1, reg=1e-5, init='he_
 	model.add(TensorProd2D(200, n_features, kernel_initializer=init, kernel_regularizer=l2(reg)))
 
 	if from_logits is True:
-		model.add(Permute((1, 3, 4, 2)))
+		model.add(Permute((2, 3, 1)))
 
 	if from_logits is False:
 		model.add(Activation(axis_softmax))
@@ -340,45 +342,45 @@ def dilated_bn_feature_net_81x81(input_shape=(2, 1080, 1280), n_features=3, n_ch
 
 	model = Sequential()
 	d = 1
-	model.add(Conv2D(64, (3, 3), dilution_rate=d, kernel_initializer=init, padding='valid', input_shape=(n_channels, 81, 11), kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', input_shape=input_shape, kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 
-	model.add(Conv2D(64, (4, 4), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
-	model.add(dilated_MaxPool2D(dilution_rate=d, pool_size=(2, 2)))
+	model.add(dilated_MaxPool2D(dilation_rate=d, pool_size=(2, 2)))
 	d *= 2
 
-	model.add(Conv2D(64, (3, 3), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 
-	model.add(Conv2D(64, (3, 3), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 
-	model.add(Conv2D(64, (3, 3), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
-	model.add(dilated_MaxPool2D(dilution_rate=d, pool_size=(2, 2)))
+	model.add(dilated_MaxPool2D(dilation_rate=d, pool_size=(2, 2)))
 	d *= 2
 
-	model.add(Conv2D(64, (3, 3), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 
-	model.add(Conv2D(64, (3, 3), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
-	model.add(dilated_MaxPool2D(pool_size=(2, 2)))
+	model.add(dilated_MaxPool2D(dilation_rate=d, pool_size=(2, 2)))
 	d *= 2
 
-	model.add(Conv2D(64, (3, 3), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 
-	model.add(Conv2D(200, (4, 4), dilution_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
+	model.add(Conv2D(200, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg)))
 	model.add(BatchNormalization(axis=1))
 	model.add(Activation('relu'))
 
@@ -389,7 +391,7 @@ def dilated_bn_feature_net_81x81(input_shape=(2, 1080, 1280), n_features=3, n_ch
 	model.add(TensorProd2D(200, n_features, kernel_initializer=init, kernel_regularizer=l2(reg)))
 
 	if from_logits is True:
-		model.add(Permute((1, 3, 4, 2)))
+		model.add(Permute((2, 3, 1)))
 
 	if from_logits is False:
 		model.add(Activation(axis_softmax))
@@ -465,61 +467,58 @@ def dilated_bn_multires_feature_net_61x61(input_shape=(2, 1080, 1280), n_feature
 
 	d = 1
 	inputs = Input(shape=input_shape)
-	conv1 = Conv2D(32, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(inputs)
+	conv1 = Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(inputs)
 	norm1 = BatchNormalization(axis=1)(conv1)
 	act1 = Activation('relu')(norm1)
 
-	conv2 = Conv2D(32, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(act1)
+	conv2 = Conv2D(64, (4, 4), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(act1)
 	norm2 = BatchNormalization(axis=1)(conv2)
 	act2 = Activation('relu')(norm2)
 	pool1 = dilated_MaxPool2D(dilation_rate=d, pool_size=(2, 2))(act2)
 	d *= 2
 
-	conv3 = Conv2D(32, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool1)
+	conv3 = Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool1)
 	norm3 = BatchNormalization(axis=1)(conv3)
 	act3 = Activation('relu')(norm3)
 
-	conv4 = Conv2D(32, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(act3)
+	conv4 = Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(act3)
 	norm4 = BatchNormalization(axis=1)(conv4)
 	act4 = Activation('relu')(norm4)
 	pool2 = dilated_MaxPool2D(dilation_rate=d, pool_size=(2, 2))(act4)
 	d *= 2
 
-	conv5 = Conv2D(32, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool2)
+	conv5 = Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool2)
 	norm5 = BatchNormalization(axis=1)(conv5)
 	act5 = Activation('relu')(norm5)
 
-	conv6 = Conv2D(32, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(act5)
+	conv6 = Conv2D(64, (3, 3), dilation_rate=d, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(act5)
 	norm6 = BatchNormalization(axis=1)(conv6)
 	act6 = Activation('relu')(norm6)
 	pool3 = dilated_MaxPool2D(dilation_rate=d, pool_size=(2, 2))(act6)
 	d *= 2
 
-	side_conv0 = Conv2D(32, (59, 59), dilation_rate=1, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(conv1)
-	side_norm0 = BatchNormalization(axis=1)(side_conv0)
-	side_act0 = Activation('relu')(side_norm0)
-
-	side_conv1 = Conv2D(32, (28, 28), dilation_rate=2, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool1)
+	side_conv1 = Conv2D(64, (28, 28), dilation_rate=2, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool1)
 	side_norm1 = BatchNormalization(axis=1)(side_conv1)
 	side_act1 = Activation('relu')(side_norm1)
 
-	side_conv2 = Conv2D(32, (12, 12), dilation_rate=4, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool2)
+	side_conv2 = Conv2D(64, (12, 12), dilation_rate=4, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool2)
 	side_norm2 = BatchNormalization(axis=1)(side_conv2)
 	side_act2 = Activation('relu')(side_norm2)
 
-	side_conv3 = Conv2D(32, (4, 4), dilation_rate=8, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool3)
+	side_conv3 = Conv2D(64, (4, 4), dilation_rate=8, kernel_initializer=init, padding='valid', kernel_regularizer=l2(reg))(pool3)
 	side_norm3 = BatchNormalization(axis=1)(side_conv3)
 	side_act3 = Activation('relu')(side_norm3)
 
 	merge_layer1 = Concatenate(axis=1)([side_act1, side_act2, side_act3])
 
-	tensor_prod1 = TensorProd2D(128, 64, kernel_initializer=init, kernel_regularizer=l2(reg))(merge_layer1)
+	tensor_prod1 = TensorProd2D(192, 256, kernel_initializer=init, kernel_regularizer=l2(reg))(merge_layer1)
 	norm7 = BatchNormalization(axis=1)(tensor_prod1)
 	act7 = Activation('relu')(norm7)
 
-	tensor_prod2 = TensorProd2D(64, n_features, kernel_initializer=init, kernel_regularizer=l2(reg))(act7)
+	tensor_prod2 = TensorProd2D(256, n_features, kernel_initializer=init, kernel_regularizer=l2(reg))(act7)
 	act8 = Activation(axis_softmax)(tensor_prod2)
 
+	final_layer = act8
 	if permute:
 		final_layer = Permute((2, 3, 1))(act8)
 
@@ -653,3 +652,120 @@ def dilated_bn_feature_net_gather_61x61(input_shape=(2, 1080, 1280), training_ex
 	print(model.output_shape)
 
 	return model
+
+"""
+Patch to dilated weight transfer
+"""
+
+dilated_twins = {
+	bn_feature_net_21x21: dilated_bn_feature_net_21x21,
+	bn_feature_net_31x31: dilated_bn_feature_net_31x31,
+	bn_feature_net_61x61: dilated_bn_feature_net_61x61,
+	bn_feature_net_81x81: dilated_bn_feature_net_81x81,
+	bn_multires_feature_net_61x61: dilated_bn_multires_feature_net_61x61
+}
+
+def transfer_patch_weights(patch_model, dilated_model):
+	"""Copy the weights of a patch classifier into its dilated twin.
+	The layers holding weights are matched in order, and their shapes have
+	to agree. The dilated twin only differs by its dilation rates, strided
+	pooling and the final flatten.
+	# Returns
+		The dilated model.
+	"""
+	patch_layers = [layer for layer in patch_model.layers if layer.weights]
+	dilated_layers = [layer for layer in dilated_model.layers if layer.weights]
+	if len(patch_layers) != len(dilated_layers):
+		raise ValueError('The patch model has %s layers with weights and the dilated '
+						'model has %s' % (len(patch_layers), len(dilated_layers)))
+
+	for patch_layer, dilated_layer in zip(patch_layers, dilated_layers):
+		weights = patch_layer.get_weights()
+		patch_shapes = [w.shape for w in weights]
+		dilated_shapes = [K.int_shape(w) for w in dilated_layer.weights]
+		if patch_shapes != dilated_shapes:
+			raise ValueError('Layer %s of the patch model has weights of shapes %s, '
+							'but layer %s of the dilated model has %s' % (patch_layer.name, patch_shapes,
+							dilated_layer.name, dilated_shapes))
+		dilated_layer.set_weights(weights)
+
+	return dilated_model
+
+def validate_dilated_model(patch_model, dilated_model, batch_size=256, atol=1e-4):
+	"""Check that a dilated model reproduces the per-pixel output of its
+	patch classifier on a random image, and time both.
+	The patch model is run on every window of the image, so the input of the
+	dilated model should be small.
+	# Returns
+		A dict with the maximum absolute difference, whether it is within
+		atol, the time of both evaluations and the speedup of the dilated model.
+	"""
+	window_x, window_y = patch_model.input_shape[2:]
+	win_x, win_y = (window_x - 1)/2, (window_y - 1)/2
+	image = np.random.normal(size=(1,) + dilated_model.input_shape[1:]).astype(K.floatx())
+
+	# Windows as a batch of patches, in the row-major order of the dense output
+	windows = sliding_window_view(image[0], win_x, win_y)
+	n_channels, output_x, output_y = windows.shape[:3]
+	patches = np.ascontiguousarray(np.moveaxis(windows, 0, 2)).reshape(-1, n_channels, window_x, window_y)
+
+	# The first calls compile the predict functions and are not timed
+	dilated_model.predict(image)
+	patch_model.predict(patches[:batch_size], batch_size=batch_size)
+
+	start = time.time()
+	dense_output = dilated_model.predict(image)[0]
+	dilated_time = time.time() - start
+
+	start = time.time()
+	patch_output = patch_model.predict(patches, batch_size=batch_size)
+	patch_time = time.time() - start
+
+	patch_output = np.moveaxis(patch_output.reshape(output_x, output_y, -1), 2, 0)
+	max_error = float(np.amax(np.abs(dense_output - patch_output)))
+
+	report = {"max_error": max_error,
+			"equivalent": max_error <= atol,
+			"patch_time": patch_time,
+			"dilated_time": dilated_time,
+			"speedup": patch_time / dilated_time}
+
+	print("Dilated model max abs error: %.3g (%s), %d pixels in %.3fs dense vs %.3fs per patch, speedup %.1fx" %
+			(max_error, "ok" if report["equivalent"] else "MISMATCH", output_x * output_y,
+			dilated_time, patch_time, report["speedup"]))
+	return report
+
+def convert_patch_model(patch_model, patch_model_fn=None, dilated_model_fn=None, input_shape=None,
+						validate=True, validation_size=(32, 32), **kwargs):
+	"""Build the dilated twin of a trained patch classifier for dense inference.
+	# Arguments
+		patch_model: the trained patch classifier.
+		patch_model_fn: the function that built patch_model, used to look up
+			its dilated twin in dilated_twins.
+		dilated_model_fn: the dilated model function, instead of patch_model_fn.
+		input_shape: (n_channels, size_x, size_y) input shape of the dilated model.
+		validate: check the transferred weights with validate_dilated_model,
+			on an image with a dense output of validation_size.
+		kwargs: passed to validate_dilated_model.
+	# Returns
+		The dilated model, and the validation report (None if validate is False).
+	"""
+	if dilated_model_fn is None:
+		dilated_model_fn = dilated_twins[patch_model_fn]
+
+	n_channels, window_x, window_y = patch_model.input_shape[1:]
+	n_features = patch_model.output_shape[-1]
+	if input_shape is None:
+		input_shape = (n_channels, 1080, 1280)
+
+	dilated_model = dilated_model_fn(input_shape=input_shape, n_features=n_features)
+	transfer_patch_weights(patch_model, dilated_model)
+
+	report = None
+	if validate:
+		validation_shape = (n_channels, window_x + validation_size[0] - 1, window_y + validation_size[1] - 1)
+		validation_model = dilated_model_fn(input_shape=validation_shape, n_features=n_features)
+		transfer_patch_weights(patch_model, validation_model)
+		report = validate_dilated_model(patch_model, validation_model, **kwargs)
+
+	return dilated_model, report
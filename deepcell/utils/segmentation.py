@@ -20,6 +20,8 @@ from numpy.fft import fft2, ifft2, fftshift
 from skimage.io import imread
 from scipy import ndimage
 import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import scipy.ndimage as ndi
 from scipy import linalg
 import re
@@ -43,10 +45,144 @@ from sklearn.utils import class_weight
 
 
 
-def segment_nuclei(img = None, save = True, adaptive = False, color_image = False, load_from_direc = None, feature_to_load = "feature_1", mask_location = None, threshold = 0.5, area_threshold = 50, eccentricity_threshold = 1, solidity_threshold = 0):
+def fill_label_holes(seg):
+	"""Fill the holes of every object of a label image at once.
+	Labeled objects never touch, so the holes of the union of the objects are
+	the holes of single objects, and every filled component belongs to the
+	object on its outer boundary, which holds its first pixel in raster order.
+	Objects lying inside the hole of another one are absorbed by it.
+	"""
+	filled = label(binary_fill_holes(seg > 0))
+	component_ids, first_pixels = np.unique(filled.ravel(), return_index = True)
+	outer_label = np.zeros(np.amax(filled) + 1, dtype = seg.dtype)
+	outer_label[component_ids] = seg.ravel()[first_pixels]
+	outer_label[0] = 0
+	return outer_label[filled]
+
+def reject_regions(seg, area_threshold = 50, eccentricity_threshold = 1, solidity_threshold = 0):
+	"""Table, indexed by label, of the objects that fail the area, eccentricity or solidity thresholds.
+	Shape properties are only computed when their threshold can reject an object.
+	"""
+	areas = np.bincount(seg.ravel())
+	rejected = (areas < area_threshold) & (areas > 0)
+	rejected[0] = False
+
+	if eccentricity_threshold < 1 or solidity_threshold > 0:
+		for region in regionprops(seg):
+			if region.eccentricity > eccentricity_threshold or region.solidity < solidity_threshold:
+				rejected[region.label] = True
+	return rejected
+
+def fill_object_holes(seg, mask):
+	"""Set mask to 1 over every object of seg with its holes filled, in place.
+	Each object is filled inside its bounding box padded by one background
+	pixel, which connects to the outside exactly like the rest of the frame.
+	Unlike fill_label_holes, objects may touch.
+	"""
+	for index, object_slice in enumerate(ndimage.find_objects(seg)):
+		if object_slice is None:
+			continue
+		obj = np.pad(seg[object_slice] == index + 1, 1, mode = 'constant')
+		mask[object_slice][binary_fill_holes(obj)[1:-1,1:-1]] = 1
+	return mask
+
+def save_segmentation(mask, frame, mask_location, name, save = True, color_image = False):
+	if save:
+		img_name = os.path.join(mask_location, name + "_mask_" + str(frame) + ".png")
+		tiff.imsave(img_name,np.float32(mask))
+
+	if color_image:
+		img_name = os.path.join(mask_location, name + "_colorimg_" + str(frame) + ".png")
+		
+		from skimage.segmentation import find_boundaries
+		import palettable
+		from skimage.color import label2rgb
+
+		seg = label(mask)
+		bound = find_boundaries(seg, background = 0)
+
+		image_label_overlay = label2rgb(seg, bg_label = 0, bg_color = (0.8,0.8,0.8), colors = palettable.colorbrewer.sequential.YlGn_9.mpl_colors)
+		image_label_overlay[bound == 1,:] = 0
+
+		scipy.misc.imsave(img_name,np.float32(image_label_overlay))
+
+_frame_worker_state = {}
+
+def _init_frame_worker(frame_function, output, inputs, kwargs):
+	_frame_worker_state.update(frame_function = frame_function, output = output, inputs = inputs, kwargs = kwargs)
+
+def _run_frame(frame):
+	state = _frame_worker_state
+	inputs = [stack[frame] for stack in state["inputs"]]
+	state["frame_function"](frame, state["output"][frame], *inputs, **state["kwargs"])
+	return frame
+
+def segment_frames(frame_function, output, inputs, workers = 1, threads = False, **kwargs):
+	"""Run frame_function(frame, output[frame], *[stack[frame] for stack in inputs], **kwargs) on every frame.
+	Frames are independent: with several workers they run on a process pool,
+	the input stacks and the output are moved to shared memory and every
+	worker writes its frames straight into the output. With threads, they
+	run on a thread pool of this process instead, which shares the arrays
+	as they are and relies on the numpy, scipy and mahotas loops releasing
+	the GIL.
+	# Arguments
+		frame_function: module level function filling output[frame] in place.
+		output: the preallocated output stack.
+		inputs: list of input stacks, indexed by frame.
+		workers: number of worker processes or threads, 1 runs in this process.
+		threads: use a thread pool instead of a process pool.
+	# Returns
+		The output stack, a shared memory copy when workers > 1 without threads.
+	"""
+	def run_frame(frame):
+		frame_function(frame, output[frame], *[stack[frame] for stack in inputs], **kwargs)
+
+	frames = xrange(output.shape[0])
+	if workers <= 1:
+		for frame in frames:
+			run_frame(frame)
+		return output
+
+	if threads:
+		pool = ThreadPool(workers)
+		try:
+			pool.map(run_frame, frames)
+		finally:
+			pool.close()
+			pool.join()
+		return output
+
+	output = to_shared_array(output)
+	inputs = [to_shared_array(stack) for stack in inputs]
+
+	# Workers are forked with the shared arrays, only frame numbers go through the pool
+	pool = multiprocessing.Pool(workers, _init_frame_worker, (frame_function, output, inputs, kwargs))
+	try:
+		for _ in pool.imap_unordered(_run_frame, frames):
+			pass
+	finally:
+		pool.close()
+		pool.join()
+	return output
+
+def segment_nuclei_frame(frame, nuclear_mask, interior, adaptive = False, threshold = 0.5, area_threshold = 50, eccentricity_threshold = 1, solidity_threshold = 0, save = True, color_image = False, mask_location = None):
+	from skimage.filters import threshold_adaptive
+
+	if adaptive:
+		block_size = 61
+		nuclear_mask[:] = threshold_adaptive(interior, block_size, method = 'median', offset = -.075)
+	else: 
+		nuclear_mask[:] = interior > threshold
+	nuc_label = fill_label_holes(label(nuclear_mask))
+
+	rejected = reject_regions(nuc_label, area_threshold = area_threshold,
+		eccentricity_threshold = eccentricity_threshold, solidity_threshold = solidity_threshold)
+	nuclear_mask[rejected[nuc_label]] = 0
+
+	save_segmentation(nuclear_mask, frame, mask_location, "nuclear", save = save, color_image = color_image)
+
+def segment_nuclei(img = None, save = True, adaptive = False, color_image = False, load_from_direc = None, feature_to_load = "feature_1", mask_location = None, threshold = 0.5, area_threshold = 50, eccentricity_threshold = 1, solidity_threshold = 0, workers = 1, threads = False):
 	# Requires a 4 channel image (number of frames, number of features, image width, image height)
-	from skimage.filters import threshold_otsu, threshold_adaptive
-
 	if load_from_direc is None:
 		img = img[:,1,:,:]
 		nuclear_masks = np.zeros(img.shape, dtype = np.float32)
@@ -61,53 +197,29 @@ def segment_nuclei(img = None, save = True, adaptive = False, color_image = Fals
 			img[counter,:,:] = get_image(os.path.join(load_from_direc,name))
 			counter += 1
 
-	for frame in xrange(img.shape[0]):
-		interior = img[frame,:,:]
-		if adaptive:
-			block_size = 61
-			nuclear_mask = np.float32(threshold_adaptive(interior, block_size, method = 'median', offset = -.075))
-		else: 
-			nuclear_mask = np.float32(interior > threshold)
-		nuc_label = label(nuclear_mask)
-		max_cell_id = np.amax(nuc_label)
-		for cell_id in xrange(1,max_cell_id + 1):
-			img_new = nuc_label == cell_id
-			img_fill = binary_fill_holes(img_new)
-			nuc_label[img_fill == 1] = cell_id
-
-		region_temp = regionprops(nuc_label)
-
-		for region in region_temp:
-			if region.area < area_threshold:
-				nuclear_mask[nuc_label == region.label] = 0
-			if region.eccentricity > eccentricity_threshold:
-				nuclear_mask[nuc_label == region.label] = 0
-			if region.solidity < solidity_threshold:
-				nuclear_mask[nuc_label == region.label] = 0
-
-		nuclear_masks[frame,:,:] = nuclear_mask
-
-		if save:
-			img_name = os.path.join(mask_location, "nuclear_mask_" + str(frame) + ".png")
-			tiff.imsave(img_name,nuclear_mask)
-
-		if color_image:
-			img_name = os.path.join(mask_location, "nuclear_colorimg_" + str(frame) + ".png")
-			
-			from skimage.segmentation import find_boundaries
-			import palettable
-			from skimage.color import label2rgb
-
-			seg = label(nuclear_mask)
-			bound = find_boundaries(seg, background = 0)
-
-			image_label_overlay = label2rgb(seg, bg_label = 0, bg_color = (0.8,0.8,0.8), colors = palettable.colorbrewer.sequential.YlGn_9.mpl_colors)
-			image_label_overlay[bound == 1,:] = 0
-
-			scipy.misc.imsave(img_name,np.float32(image_label_overlay))
-	return nuclear_masks
-
-def segment_cytoplasm(img =None, save = True, load_from_direc = None, feature_to_load = "feature_1", color_image = False, nuclear_masks = None, mask_location = None, smoothing = 1, num_iters = 80):
+	return segment_frames(segment_nuclei_frame, nuclear_masks, [img], workers = workers, threads = threads,
+		adaptive = adaptive, threshold = threshold, area_threshold = area_threshold,
+		eccentricity_threshold = eccentricity_threshold, solidity_threshold = solidity_threshold,
+		save = save, color_image = color_image, mask_location = mask_location)
+
+def segment_cytoplasm_frame(frame, cytoplasm_mask, interior, nuclei, smoothing = 1, num_iters = 80, voronoi_interval = 1, tolerance = None, window = 4, local = False, margin = 32, save = True, color_image = False, mask_location = None):
+	nuclei_label = label(nuclei, background = 0)
+
+	if local:
+		seg, iterations = segment_cells_locally(interior, nuclei_label, num_iters = num_iters, smoothing = smoothing, margin = margin,
+			voronoi_interval = voronoi_interval, tolerance = tolerance, window = window, return_iterations = True)
+	else:
+		seg, iterations = segment_image_w_morphsnakes(interior, nuclei_label, num_iters = num_iters, smoothing = smoothing,
+			voronoi_interval = voronoi_interval, tolerance = tolerance, window = window, return_iterations = True)
+	if tolerance is not None:
+		print("Frame " + str(frame) + ": active contours stopped after " + str(iterations) + " of " + str(num_iters) + " iterations")
+	seg[seg == 0] = -1
+
+	fill_object_holes(seg, cytoplasm_mask)
+
+	save_segmentation(cytoplasm_mask, frame, mask_location, "cytoplasm", save = save, color_image = color_image)
+
+def segment_cytoplasm(img =None, save = True, load_from_direc = None, feature_to_load = "feature_1", color_image = False, nuclear_masks = None, mask_location = None, smoothing = 1, num_iters = 80, voronoi_interval = 1, tolerance = None, window = 4, local = False, margin = 32, workers = 1, threads = False):
 	if load_from_direc is None:
 		cytoplasm_masks = np.zeros((img.shape[0], img.shape[2], img.shape[3]), dtype = np.float32)
 		img = img[:,1,:,:]
@@ -123,42 +235,28 @@ def segment_cytoplasm(img =None, save = True, load_from_direc = None, feature_to
 			img[counter,:,:] = get_image(os.path.join(load_from_direc,name))
 			counter += 1
 
-	for frame in xrange(img.shape[0]):
-		interior = img[frame,:,:]
-
-		nuclei = nuclear_masks[frame,:,:]
-
-		nuclei_label = label(nuclei, background = 0)
-
-		seg = segment_image_w_morphsnakes(interior, nuclei_label, num_iters = num_iters, smoothing = smoothing)
-		seg[seg == 0] = -1
-
-		cytoplasm_mask = np.zeros(seg.shape,dtype = np.float32)
-		max_cell_id = np.amax(seg)
-		for cell_id in xrange(1,max_cell_id + 1):
-			img_new = seg == cell_id
-			img_fill = binary_fill_holes(img_new)
-			cytoplasm_mask[img_fill == 1] = 1
-
-		cytoplasm_masks[frame,:,:] = cytoplasm_mask
-
-		if save:
-			img_name = os.path.join(mask_location, "cytoplasm_mask_" + str(frame) + ".png")
-			tiff.imsave(img_name,np.float32(cytoplasm_mask))
-
-		if color_image:
-			img_name = os.path.join(mask_location, "cytoplasm_colorimg_" + str(frame) + ".png")
-			
-			from skimage.segmentation import find_boundaries
-			import palettable
-			from skimage.color import label2rgb
-
-			seg = label(cytoplasm_mask)
-			bound = find_boundaries(seg, background = 0)
-
-			image_label_overlay = label2rgb(seg, bg_label = 0, bg_color = (0.8,0.8,0.8), colors = palettable.colorbrewer.sequential.YlGn_9.mpl_colors)
-			image_label_overlay[bound == 1,:] = 0
-
-			scipy.misc.imsave(img_name,np.float32(image_label_overlay))
-
-	return cytoplasm_masks
\ No newline at end of file
+	return segment_frames(segment_cytoplasm_frame, cytoplasm_masks, [img, nuclear_masks], workers = workers, threads = threads,
+		smoothing = smoothing, num_iters = num_iters, voronoi_interval = voronoi_interval,
+		tolerance = tolerance, window = window, local = local, margin = margin, save = save, color_image = color_image, mask_location = mask_location)
+
+def score_cells(seg, class_1, class_2, cmap = plt.cm.coolwarm):
+	"""Score every labeled cell by the fraction of class_2 in its summed class predictions.
+	All cells are scored in one pass over the label image, and the color map
+	is applied through a per-label lookup table.
+	Returns the score image and its RGB rendering, zero on the background.
+	"""
+	seg = np.asarray(seg, dtype = np.intp)
+	num_of_labels = np.amax(seg) + 1
+
+	class_1_sum = np.bincount(seg.ravel(), weights = class_1.ravel(), minlength = num_of_labels)
+	class_2_sum = np.bincount(seg.ravel(), weights = class_2.ravel(), minlength = num_of_labels)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		scores = class_2_sum / (class_1_sum + class_2_sum)
+	scores[0] = 0
+
+	colors = np.asarray(cmap(scores)[:, :3], dtype = np.float32)
+	colors[0] = 0
+
+	prediction = scores.astype(np.float32)[seg]
+	prediction_color = colors[seg]
+	return prediction, prediction_color